@@ -14,45 +14,2026 @@ else:
     from gi.repository import GLib as gobject
 import sys
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests # for http GET
+import urllib3
 import configparser # for config/ini file
+import json
+import queue
+import signal
+import struct
+import csv
+import io
+import cProfile
+import pstats
+from array import array
+from bisect import bisect_right
+from collections import namedtuple, deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
  
 import pytz
+
+try:
+  import paho.mqtt.client as mqtt # optional, only for MQTT push ingestion
+except ImportError:
+  mqtt = None
 from datetime import datetime, timezone 
  
-# our own packages from victron
-sys.path.insert(1, os.path.join(os.path.dirname(__file__), '/opt/victronenergy/dbus-systemcalc-py/ext/velib_python'))
+# our own packages from victron, a checkout given by VELIB_PYTHON outside of Venus OS
+sys.path.insert(1, os.environ.get('VELIB_PYTHON', '/opt/victronenergy/dbus-systemcalc-py/ext/velib_python'))
 from vedbus import VeDbusService
 
 
-class DbusGoeChargerService:
-  def __init__(self, servicename, paths, productname='go-eCharger', connection='go-eCharger HTTP JSON service'):
-    config = self._getConfig()
+# one logger per subsystem, their level follows Log_Level unless set with Log_Level_<name>
+logWallbox = logging.getLogger('WALLBOX')
+logBattery = logging.getLogger('BATT')
+logNightMode = logging.getLogger('NightMode')
+logHttp = logging.getLogger('HTTP')
+SUBSYSTEM_LOGGERS = (logWallbox, logBattery, logNightMode, logHttp)
+
+
+# parsed config.ini, one immutable tuple per section
+DefaultSettings = namedtuple('DefaultSettings', ['accessType', 'signOfLifeLog', 'deviceinstance', 'name', 'hardwareVersion', 'logLevel',
+                                                 'phaseL1', 'switchL1L2', 'asyncPoll', 'pollsInFlight', 'pollStaleAfter', 'apiVersion',
+                                                 'updateInterval', 'logFile', 'idleInterval', 'connectedInterval', 'chargingInterval',
+                                                 'boostInterval', 'boostDuration', 'pvInterval', 'batteryInterval', 'nightModeInterval',
+                                                 'subsystemLogLevels', 'logMaxSize', 'logBackups', 'debugHistory', 'backoff', 'backoffMax'])
+OnPremiseSettings = namedtuple('OnPremiseSettings', ['host', 'poolSize', 'connectTimeout', 'readTimeout', 'writeInterval', 'writeRetries', 'confirmTimeout'])
+LoadSettings = namedtuple('LoadSettings', ['disableDischargeAtPower', 'disableExternalDischargeAtPower'])
+NightModeSettings = namedtuple('NightModeSettings', ['startHour', 'endHour', 'maxExternalSOC', 'minExternalSOC',
+                                                     'maxExternalCharge', 'gridSetPoint', 'maxDischarge'])
+MqttSettings = namedtuple('MqttSettings', ['host', 'port', 'topic', 'watchdogInterval', 'minInterval'])
+RecorderSettings = namedtuple('RecorderSettings', ['enabled', 'file', 'maxFileSize', 'maxFiles', 'flushInterval'])
+BalancerSettings = namedtuple('BalancerSettings', ['mainFuse'])
+ScheduleSettings = namedtuple('ScheduleSettings', ['forecastFile', 'tariffFile', 'slotMinutes', 'replanInterval', 'nightPvThreshold',
+                                                   'socPerHour', 'cheapHours', 'chargeCurrent', 'chargeExtPower'])
+ChargerSettings = namedtuple('ChargerSettings', ['name', 'host', 'deviceinstance', 'guiName', 'hardwareVersion', 'apiVersion', 'phaseL1', 'switchL1L2',
+                                                 'mqttTopic', 'priority', 'phaseSwitching', 'statusUrl', 'mqttPayloadUrl', 'apiStatusUrl', 'apiSetUrl',
+                                                 'modeFile'])
+MetricsSettings = namedtuple('MetricsSettings', ['port', 'address', 'interval'])
+Settings = namedtuple('Settings', ['default', 'onPremise', 'load', 'nightMode', 'mqtt', 'recorder', 'balancer', 'schedule', 'metrics', 'chargers'])
+
+
+class RepeatFilter(logging.Filter):
+  """Let a message through at most once per interval seconds, messages are told apart by logger, level and text.
+  
+  DEBUG, ERROR and CRITICAL records always pass. The next record that passes tells how many repeats were dropped
+  before it.
+  """
+  MAX_MESSAGES = 1000
+  
+  def __init__(self, interval=60.0):
+    logging.Filter.__init__(self)
+    self._interval = interval
+    self._last = {}   # (name, level, message) -> [time, dropped repeats]
+    self._lock = threading.Lock()
+    self.suppressed = 0
+  
+  def filter(self, record):
+    if record.levelno <= logging.DEBUG or record.levelno >= logging.ERROR:
+      return True
+    
+    # the formatted text, the queue handler formats the record anyway
+    message = record.getMessage()
+    key = (record.name, record.levelno, message)
+    with self._lock:
+      entry = self._last.get(key)
+      if entry is not None and record.created - entry[0] < self._interval:
+        entry[1] = entry[1] + 1
+        self.suppressed = self.suppressed + 1
+        return False
+      if entry is not None and entry[1]:
+        record.msg = "%s (%s repeats suppressed)" % (message, entry[1])
+        record.args = None
+      elif len(self._last) >= self.MAX_MESSAGES:
+        self._last.clear()
+      self._last[key] = [record.created, 0]
+    return True
+
+
+class LogLevelFilter(logging.Filter):
+  """Level of the log output per logger, for handlers behind loggers that let everything through."""
+  def __init__(self):
+    logging.Filter.__init__(self)
+    self.configure(logging.INFO, {})
+  
+  def configure(self, level, levels):
+    self._level = level
+    self._levels = dict(levels)
+  
+  def filter(self, record):
+    return record.levelno >= self._levels.get(record.name, self._level)
+
+
+class DebugHistory(logging.Handler):
+  """The records of the last `minutes` in RAM, written to a file on an error or on request.
+  
+  The file is overwritten by each dump, after a dump the next error only dumps again once the history holds
+  none of the dumped records. The flash sees one write of the history per incident instead of a DEBUG log.
+  """
+  MAX_RECORDS = 20000
+  
+  def __init__(self, path, minutes):
+    logging.Handler.__init__(self, logging.DEBUG)
+    self._path = path
+    self._seconds = minutes * 60
+    self._records = deque(maxlen=self.MAX_RECORDS)
+    self._lastDump = 0
+    self.dumps = 0
+    self.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s', '%Y-%m-%d %H:%M:%S'))
+  
+  def emit(self, record):
+    # called with the lock of the handler held
+    self._records.append(record)
+    while record.created - self._records[0].created > self._seconds:
+      self._records.popleft()
+    if record.levelno >= logging.ERROR and record.created - self._lastDump > self._seconds:
+      self._dump(record.created)
+  
+  def dump(self):
+    # from the GLib loop, e.g. on SIGUSR2
+    with self.lock:
+      self._dump(time.time())
+    return True
+  
+  def _dump(self, now):
+    try:
+      with open(self._path, 'w') as file:
+        for record in self._records:
+          file.write(self.format(record) + '\n')
+      self._lastDump = now
+      self.dumps = self.dumps + 1
+    except Exception:
+      self.handleError(self._records[-1])
+
+
+# levels of the log output, set from config.ini by setLogLevels
+logOutputLevels = LogLevelFilter()
+# the DebugHistory handler if DebugHistory is set at the start
+logDebugHistory = None
+
+
+class ConfigFile:
+  """config.ini parsed once into Settings, re-read only when the file changed on disk or on request."""
+  LOG_LEVELS = {'logging.DEBUG': logging.DEBUG,
+                'logging.INFO': logging.INFO,
+                'logging.WARNING': logging.WARNING,
+                'logging.ERROR': logging.ERROR,
+                }
+  
+  def __init__(self, path):
+    self._path = path
+    self._mtime = None
+    self.settings = None
+    self.load()
+  
+  def _getMtime(self):
+    try:
+      return os.stat(self._path).st_mtime
+    except OSError:
+      return None
+  
+  def load(self):
+    mtime = self._getMtime()
+    config = configparser.ConfigParser(strict=False)
+    config.read(self._path)
+    self.settings = self._parse(config)
+    self._mtime = mtime
+    return self.settings
+  
+  def reloadIfChanged(self):
+    mtime = self._getMtime()
+    if mtime is None or mtime == self._mtime:
+      return False
+    
+    try:
+      self.load()
+    except Exception as e:
+      # keep running with the last good settings
+      self._mtime = mtime
+      logging.error("Reload of %s failed, keep previous settings: %s", self._path, e)
+      return False
+    return True
+  
+  def _parse(self, config):
+    for section in ('ONPREMISE', 'LOAD', 'NIGHTMODE', 'MQTT', 'RECORDER', 'BALANCER', 'SCHEDULE', 'METRICS'):
+      if not config.has_section(section):
+        config.add_section(section)
+    
+    default = config['DEFAULT']
+    signOfLifeLog = default.get('SignOfLifeLog', '')
+    updateInterval = default.getint('UpdateInterval',1000)
+    defaultSettings = DefaultSettings(
+      accessType = default['AccessType'],
+      signOfLifeLog = int(signOfLifeLog) if signOfLifeLog else 0,
+      deviceinstance = int(default['Deviceinstance']),
+      name = default['Name'],
+      hardwareVersion = int(default['HardwareVersion']),
+      logLevel = self.LOG_LEVELS.get(default.get('Log_Level'), logging.ERROR),
+      phaseL1 = default.getint('PhaseL1',1),
+      switchL1L2 = default.getboolean('SwitchL1L2',False),
+      asyncPoll = default.getboolean('AsyncPoll',False),
+      pollsInFlight = default.getint('PollsInFlight',1),
+      pollStaleAfter = default.getfloat('PollStaleAfter',10.0),
+      apiVersion = default.getint('ApiVersion',1),
+      updateInterval = updateInterval,
+      logFile = os.path.join(os.path.dirname(self._path), default.get('LogFile', 'goeCharger_Vorne.log')),
+      idleInterval = default.getint('IdleInterval',5*updateInterval),
+      connectedInterval = default.getint('ConnectedInterval',updateInterval),
+      chargingInterval = default.getint('ChargingInterval',updateInterval),
+      boostInterval = default.getint('BoostInterval',max(1, updateInterval//4)),
+      boostDuration = default.getfloat('BoostDuration',5.0),
+      pvInterval = default.getint('PvInterval',updateInterval),
+      batteryInterval = default.getint('BatteryInterval',15*updateInterval),
+      nightModeInterval = default.getint('NightModeInterval',60000),
+      subsystemLogLevels = tuple((logger.name, self.LOG_LEVELS[default['Log_Level_' + logger.name]]) for logger in SUBSYSTEM_LOGGERS
+                                 if default.get('Log_Level_' + logger.name) in self.LOG_LEVELS),
+      logMaxSize = default.getint('LogMaxSize',1024*1024),
+      logBackups = default.getint('LogBackups',2),
+      debugHistory = default.getfloat('DebugHistory',0),
+      backoff = default.getfloat('Backoff',2.0),
+      backoffMax = default.getfloat('BackoffMax',300.0))
+    
+    onPremise = config['ONPREMISE']
+    onPremiseSettings = OnPremiseSettings(
+      host = onPremise.get('Host'),
+      poolSize = onPremise.getint('PoolSize',2),
+      connectTimeout = onPremise.getfloat('ConnectTimeout',2.0),
+      readTimeout = onPremise.getfloat('ReadTimeout',5.0),
+      writeInterval = onPremise.getfloat('WriteInterval',2.0),
+      writeRetries = onPremise.getint('WriteRetries',5),
+      confirmTimeout = onPremise.getfloat('ConfirmTimeout',10.0))
+    
+    load = config['LOAD']
+    loadSettings = LoadSettings(
+      disableDischargeAtPower = load.getint('DisableDischargeAtPower',None),
+      disableExternalDischargeAtPower = load.getint('DisableExternalDischargeAtPower',None))
+    
+    nightMode = config['NIGHTMODE']
+    nightModeSettings = NightModeSettings(
+      startHour = nightMode.getint('StartHour',18),
+      endHour = nightMode.getint('EndHour',6),
+      maxExternalSOC = nightMode.getfloat('MaxExternalSOC',50),
+      minExternalSOC = nightMode.getfloat('MinExternalSOC',20),
+      maxExternalCharge = nightMode.getfloat('MaxExternalCharge',0),
+      gridSetPoint = nightMode.getfloat('GridSetPoint',50),
+      maxDischarge = nightMode.getfloat('MaxDischarge',50))
+    
+    mqttSection = config['MQTT']
+    mqttSettings = MqttSettings(
+      host = mqttSection.get('Host', ''),
+      port = mqttSection.getint('Port',1883),
+      topic = mqttSection.get('Topic', ''),
+      watchdogInterval = mqttSection.getfloat('WatchdogInterval',30.0),
+      minInterval = mqttSection.getfloat('MinInterval',0.5))
+    
+    recorder = config['RECORDER']
+    recorderSettings = RecorderSettings(
+      enabled = recorder.getboolean('Enabled',False),
+      file = os.path.join(os.path.dirname(self._path), recorder.get('File', 'goeCharger_recording.bin')),
+      maxFileSize = recorder.getint('MaxFileSize',4*1024*1024),
+      maxFiles = recorder.getint('MaxFiles',4),
+      flushInterval = recorder.getfloat('FlushInterval',60.0))
+    
+    balancer = config['BALANCER']
+    balancerSettings = BalancerSettings(
+      mainFuse = balancer.getint('MainFuse',0))
+    
+    schedule = config['SCHEDULE']
+    def _file(name):
+      value = schedule.get(name, '')
+      return os.path.join(os.path.dirname(self._path), value) if value else ''
+    scheduleSettings = ScheduleSettings(
+      forecastFile = _file('ForecastFile'),
+      tariffFile = _file('TariffFile'),
+      slotMinutes = schedule.getint('SlotMinutes',60),
+      replanInterval = schedule.getfloat('ReplanInterval',900.0),
+      nightPvThreshold = schedule.getfloat('NightPvThreshold',50.0),
+      socPerHour = schedule.getfloat('SocPerHour',5.0),
+      cheapHours = schedule.getint('CheapHours',0),
+      chargeCurrent = schedule.getint('ChargeCurrent',16),
+      chargeExtPower = schedule.getfloat('ChargeExtPower',0.0))
+    if scheduleSettings.slotMinutes <= 0 or 60 % scheduleSettings.slotMinutes and scheduleSettings.slotMinutes % 60:
+      raise ValueError("SlotMinutes %s does not divide an hour" % (scheduleSettings.slotMinutes))
+    
+    metrics = config['METRICS']
+    metricsSettings = MetricsSettings(
+      port = metrics.getint('Port',0),
+      address = metrics.get('Address', '127.0.0.1'),
+      interval = metrics.getfloat('Interval',10.0))
+    
+    if defaultSettings.accessType != 'OnPremise':
+      raise ValueError("AccessType %s is not supported" % (defaultSettings.accessType))
+    
+    # one [CHARGER:<name>] section per wallbox, without any the DEFAULT and ONPREMISE values describe the only one
+    chargers = []
+    for section in config.sections():
+      if section.startswith('CHARGER:'):
+        chargers.append(self._parseCharger(section[len('CHARGER:'):], config[section], defaultSettings, onPremiseSettings, mqttSettings))
+    if not chargers:
+      chargers.append(self._parseCharger('', default, defaultSettings, onPremiseSettings, mqttSettings))
+    
+    if len(set(charger.deviceinstance for charger in chargers)) != len(chargers):
+      raise ValueError("Deviceinstance of the chargers is not unique")
+    
+    return Settings(default = defaultSettings, onPremise = onPremiseSettings, load = loadSettings, nightMode = nightModeSettings,
+                    mqtt = mqttSettings, recorder = recorderSettings, balancer = balancerSettings, schedule = scheduleSettings,
+                    metrics = metricsSettings, chargers = tuple(chargers))
+  
+  def _parseCharger(self, name, section, defaultSettings, onPremiseSettings, mqttSettings):
+    # charger sections inherit DEFAULT through configparser, Host and Topic fall back to ONPREMISE and MQTT
+    host = section.get('Host', onPremiseSettings.host)
+    if not host:
+      raise ValueError("No Host configured for charger %s" % (name or defaultSettings.name))
+    
+    charger = ChargerSettings(
+      name = name,
+      host = host,
+      deviceinstance = int(section['Deviceinstance']),
+      guiName = section['Name'],
+      hardwareVersion = int(section['HardwareVersion']),
+      apiVersion = section.getint('ApiVersion',1),
+      phaseL1 = section.getint('PhaseL1',1),
+      switchL1L2 = section.getboolean('SwitchL1L2',False),
+      mqttTopic = section.get('Topic', '') if name else mqttSettings.topic,
+      priority = section.getint('Priority',1),
+      phaseSwitching = section.getboolean('PhaseSwitching',False),
+      statusUrl = "http://%s/status" % (host),
+      mqttPayloadUrl = "http://%s/mqtt?payload=" % (host) + "%s=%s",
+      apiStatusUrl = "http://%s/api/status?filter=%s" % (host, ','.join(GoeChargerApiV2.STATUS_KEYS)),
+      apiSetUrl = "http://%s/api/set?" % (host),
+      modeFile = os.path.join(os.path.dirname(self._path), "goeCharger_mode_%s" % (section['Deviceinstance'])))
+    
+    if charger.apiVersion not in (1, 2):
+      raise ValueError("ApiVersion %s is not supported" % (charger.apiVersion))
+    if charger.phaseSwitching and charger.apiVersion != 2:
+      raise ValueError("PhaseSwitching needs ApiVersion 2")
+    
+    return charger
+
+
+class CircuitBreaker:
+  """Health of one dependency of the service.
+  
+  After `threshold` failures in a row no more calls are let through (open) for `delay` seconds, then one probe is
+  (half-open). A failed probe doubles the delay up to maxDelay, a successful one closes the breaker again. A dead
+  dependency costs a comparison per call instead of a timeout.
+  """
+  CLOSED = 0
+  OPEN = 1
+  HALF_OPEN = 2
+  # text of the states on D-Bus
+  STATES = {CLOSED: 'Ok', OPEN: 'Unavailable', HALF_OPEN: 'Probing'}
+  
+  def __init__(self, name, baseDelay=2.0, maxDelay=300.0, threshold=1, logger=None):
+    self.name = name
+    self._baseDelay = baseDelay
+    self._maxDelay = maxDelay
+    self._threshold = max(1, threshold)
+    self._logger = logger if logger is not None else logging.getLogger()
+    # calls come from the GLib loop and from workers
+    self._lock = threading.Lock()
+    self._failures = 0    # failures in a row
+    self._retryAt = 0
+    
+    self.state = self.CLOSED
+    self.delay = 0
+    self.failures = 0
+    self.trips = 0
+    self.rejected = 0
+  
+  def allow(self):
+    # no lock while closed, that is every call of a healthy dependency
+    if self.state == self.CLOSED:
+      return True
+    with self._lock:
+      if self.state == self.OPEN and time.monotonic() >= self._retryAt:
+        self.state = self.HALF_OPEN
+        return True
+      # open, or the probe is still running
+      self.rejected = self.rejected + 1
+      return False
+  
+  def success(self):
+    if self.state == self.CLOSED and not self._failures:
+      return
+    with self._lock:
+      if self.state != self.CLOSED:
+        self._logger.info("%s available again after %s failures", self.name, self._failures)
+      self.state = self.CLOSED
+      self._failures = 0
+      self.delay = 0
+  
+  def failure(self, reason=None):
+    with self._lock:
+      self.failures = self.failures + 1
+      self._failures = self._failures + 1
+      if self.state == self.OPEN or (self.state == self.CLOSED and self._failures < self._threshold):
+        return
+      self._open(reason)
+  
+  def trip(self, reason=None):
+    # the dependency is known to be gone, e.g. its D-Bus name lost the owner
+    with self._lock:
+      if self.state != self.OPEN:
+        self._open(reason)
+  
+  def _open(self, reason):
+    # first trip waits baseDelay, every failed probe twice as long as the one before
+    self.delay = min(self._maxDelay, self.delay * 2 if self.delay else self._baseDelay)
+    self._retryAt = time.monotonic() + self.delay
+    if self.state == self.CLOSED:
+      self.trips = self.trips + 1
+      self._logger.warning("%s unavailable (%s), retry in %s s", self.name, reason, self.delay)
+    else:
+      self._logger.debug("%s still unavailable (%s), retry in %s s", self.name, reason, self.delay)
+    self.state = self.OPEN
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+  """Request not sent, the CircuitBreaker of the charger is open."""
+
+
+class ChargerHttpSession:
+  """Pooled keep-alive HTTP session to the go-eCharger, reconnects once when a kept-alive socket was reset."""
+  def __init__(self, poolSize=2, connectTimeout=2.0, readTimeout=5.0, breaker=None):
+    self._poolSize = max(1, poolSize)
+    self._timeout = (connectTimeout, readTimeout)
+    self._lock = threading.Lock()
+    # CircuitBreaker of the charger, optional
+    self._breaker = breaker
+    
+    self.requests = 0
+    self.connections = 0
+    self.reconnects = 0
+    self._connect()
+  
+  def _connect(self):
+    owner = self
+    
+    # count every TCP connect, a kept-alive socket is reused without one
+    class CountingHTTPConnection(urllib3.connection.HTTPConnection):
+      def _new_conn(self):
+        owner.connections = owner.connections + 1
+        return super(CountingHTTPConnection, self)._new_conn()
+    
+    class CountingHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+      ConnectionCls = CountingHTTPConnection
+    
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self._poolSize, max_retries=0)
+    adapter.poolmanager.pool_classes_by_scheme = dict(adapter.poolmanager.pool_classes_by_scheme, http=CountingHTTPConnectionPool)
+    session.mount('http://', adapter)
+    self._session = session
+  
+  def _reconnect(self, session):
+    with self._lock:
+      # another thread may have replaced the session already
+      if session is self._session:
+        self.reconnects = self.reconnects + 1
+        session.close()
+        self._connect()
+  
+  @staticmethod
+  def _isDropped(error):
+    reason = error.args[0] if error.args else None
+    if isinstance(reason, urllib3.exceptions.MaxRetryError):
+      reason = reason.reason
+    # RemoteDisconnected and ConnectionResetError on a reused connection arrive as ProtocolError
+    return isinstance(reason, urllib3.exceptions.ProtocolError)
+  
+  @property
+  def reused(self):
+    return max(0, self.requests - self.connections)
+  
+  def get(self, url):
+    breaker = self._breaker
+    if breaker is not None and not breaker.allow():
+      raise CircuitOpenError("go-eCharger unavailable, next try in %s s" % (breaker.delay))
+    
+    session = self._session
+    try:
+      try:
+        response = session.get(url, timeout=self._timeout)
+      except requests.exceptions.ConnectionError as e:
+        # only a kept-alive socket dropped by the charger is worth a retry, a refused or timed out
+        # connect would only double the wait
+        if not self._isDropped(e):
+          raise
+        logHttp.info("HTTP::Connection to go-eCharger reset, reconnect")
+        self._reconnect(session)
+        response = self._session.get(url, timeout=self._timeout)
+    except Exception as e:
+      if breaker is not None:
+        breaker.failure(e)
+      raise
+    
+    # any response, also an error status, shows the charger is reachable
+    if breaker is not None:
+      breaker.success()
+    self.requests = self.requests + 1
+    return response
+  
+  def close(self):
+    self._session.close()
+
+
+class GoeChargerApiV1:
+  """Status source for the go-eCharger HTTP API v1: full /status document, writes through /mqtt?payload=."""
+  def __init__(self, http, settings, stages=None):
+    self._http = http
+    self._statusUrl = settings.statusUrl
+    self._setUrl = settings.mqttPayloadUrl
+    # StageTimer with 'fetch' and 'parse', optional
+    self._stages = stages
+    # with PollsInFlight > 1 several workers compare and replace the last response
+    self._lock = threading.Lock()
+    self._lastContent = None
+    self._lastData = None
+    self._lastStatus = None
+    self.unchanged = 0
+  
+  def _get(self, URL):
+    request_data = self._http.get(URL)
+    
+    # check for response
+    if not request_data:
+      raise ConnectionError("No response from go-eCharger - %s" % (URL))
+    return request_data
+  
+  def _getJson(self, URL):
+    json_data = self._get(URL).json()
+    
+    # check for Json
+    if not json_data:
+      raise ValueError("Converting response to JSON failed")
+    
+    return json_data
+  
+  # keys needed to process a status, e.g. when it is assembled from pushed messages
+  REQUIRED_KEYS = ('nrg', 'amp', 'ama', 'alw', 'car', 'ast', 'eto')
+  # reboot timer and clock change with every response and are left out of the comparison
+  VOLATILE_KEYS = ('rbt', 'tme')
+  
+  def normalize(self, data):
+    return data
+  
+  def _getStatus(self, parse):
+    # an unchanged response is not processed again, the previous status object is returned as it is
+    started = time.perf_counter()
+    response = self._get(self._statusUrl)
+    content = response.content
+    if self._stages is not None:
+      self._stages.since('fetch', started)
+    with self._lock:
+      if content == self._lastContent:
+        self.unchanged = self.unchanged + 1
+        return self._lastStatus
+    
+    started = time.perf_counter()
+    json_data = response.json()
+    if not json_data:
+      raise ValueError("Converting response to JSON failed")
+    # the same response apart from the volatile keys
+    data = {key: value for key, value in json_data.items() if key not in self.VOLATILE_KEYS}
+    with self._lock:
+      if data == self._lastData:
+        self._lastContent = content
+        self.unchanged = self.unchanged + 1
+        return self._lastStatus
+    status = parse(json_data)
+    with self._lock:
+      self._lastStatus = status
+      self._lastData = data
+      self._lastContent = content
+    if self._stages is not None:
+      self._stages.since('parse', started)
+    return status
+  
+  def getStatus(self):
+    return self._getStatus(self.normalize)
+  
+  def setValues(self, values):
+    # API v1 takes one key per request, the result is confirmed by the next status
+    for parameter, value in values.items():
+      self._getJson(self._setUrl % (parameter, str(value)))
+
+
+class GoeChargerApiV2(GoeChargerApiV1):
+  """Status source for the go-eCharger HTTP API v2 (hardware version 3).
+  
+  Only the keys used by the service are requested through /api/status?filter= and converted to the
+  units and names of API v1, writes go through /api/set.
+  """
+  STATUS_KEYS = ('nrg', 'amp', 'ama', 'alw', 'car', 'eto', 'tma', 'fwv', 'sse')
+  # 'ast' of the PV control (/Mode 1) until the mode was changed
+  DEFAULT_AST = 1
+  REQUIRED_KEYS = ('nrg', 'amp', 'ama', 'alw', 'car', 'eto', 'tma')
+  
+  def __init__(self, http, settings, stages=None):
+    GoeChargerApiV1.__init__(self, http, settings, stages)
+    self._statusUrl = settings.apiStatusUrl
+    self._setUrl = settings.apiSetUrl
+    # v1 keeps the control mode in 'ast' on the charger, the 'acs' of v2 is the access control (open or
+    # RFID/app) and must not carry it, so the mode is kept by the service and survives a restart in modeFile
+    self._modeFile = settings.modeFile
+    self._ast = self.DEFAULT_AST
+    try:
+      with open(self._modeFile) as f:
+        self._ast = int(f.read().strip())
+    except (OSError, ValueError):
+      pass
+  
+  def normalize(self, data):
+    # v2 reports V, A, W and Wh, v1 0.1 A, 0.1 kW, 0.01 kW and 0.1 kWh
+    nrg = list(data['nrg'])
+    for index in (4, 5, 6):
+      nrg[index] = nrg[index] * 10
+    for index in (7, 8, 9, 10):
+      nrg[index] = nrg[index] / 100.0
+    nrg[11] = nrg[11] / 10.0
+    data['nrg'] = nrg
+    data['eto'] = data['eto'] / 100.0
+    data['alw'] = int(data['alw'])
+    data['tmp'] = data['tma'][0]
+    data['ast'] = self._ast
+    return data
+  
+  def setValues(self, values):
+    # all keys in one /api/set request
+    query = []
+    for parameter, value in sorted(values.items()):
+      if parameter == 'ast':
+        self._ast = int(value)
+        self._storeMode()
+        # the mode is not part of the response, a cached status would hide the change
+        with self._lock:
+          self._lastContent = None
+          self._lastData = None
+        continue
+      if parameter == 'alw':
+        # force state 1: off, 2: on
+        parameter = 'frc'
+        value = 2 if int(value) else 1
+      query.append("%s=%s" % (parameter, value))
+    if query:
+      self._getJson(self._setUrl + '&'.join(query))
+
+
+  def _storeMode(self):
+    # worker thread, replaced at once so a crash never leaves half a file
+    try:
+      with open(self._modeFile + '.tmp', 'w') as f:
+        f.write(str(self._ast))
+      os.replace(self._modeFile + '.tmp', self._modeFile)
+    except OSError as e:
+      logHttp.warning("HTTP::Mode %s not stored in %s: %s", self._ast, self._modeFile, e)
+
+
+class ChargerCommandQueue:
+  """Writes to the go-eCharger off the GLib loop, coalesced per key and at most one per key every minInterval.
+  
+  Keys due at the same time go out in one call of the source (one request with API v2). A write counts as done
+  when a later status shows the value, it is retried with exponential backoff if it failed or was not
+  confirmed within confirmTimeout. A newer value for a key replaces an older one that was not sent yet.
+  """
+  def __init__(self, source, executor=None, minInterval=2.0, maxRetries=5, confirmTimeout=10.0, maxBackoff=60.0, stages=None):
+    self._source = source
+    # StageTimer with 'write', optional
+    self._stages = stages
+    self._executor = executor if executor is not None else ThreadPoolExecutor(max_workers=1)
+    self._minInterval = minInterval
+    self._maxRetries = maxRetries
+    self._confirmTimeout = confirmTimeout
+    self._maxBackoff = maxBackoff
+    
+    # only touched from the GLib loop
+    self._pending = {}    # key -> value to send
+    self._sent = {}       # key -> (value, time), waiting for a status showing it
+    self._attempts = {}   # key -> failed attempts of the current value
+    self._notBefore = {}  # key -> earliest time of the next write
+    self._inFlight = False
+    self._sending = set() # keys of the write in flight
+    self._timer = None
+    
+    self.queued = 0
+    self.coalesced = 0
+    self.requests = 0
+    self.confirmed = 0
+    self.retries = 0
+    self.failed = 0
+  
+  def put(self, key, value):
+    self.queued = self.queued + 1
+    if key in self._pending:
+      self.coalesced = self.coalesced + 1
+    elif key in self._sent and self._sent[key][0] == value:
+      # same value already on its way
+      self.coalesced = self.coalesced + 1
+      return
+    self._pending[key] = value
+    self._attempts[key] = 0
+    self._schedule()
+  
+  def busy(self, key):
+    # value of the key in a status may be outdated while a write is open
+    return key in self._pending or key in self._sending or key in self._sent
+  
+  def _schedule(self):
+    if self._inFlight or self._timer is not None or not self._pending:
+      return
+    now = time.time()
+    delay = max(0.0, min(self._notBefore.get(key, 0) for key in self._pending) - now)
+    self._timer = gobject.timeout_add(int(delay * 1000), self._flush)
+  
+  def _flush(self):
+    self._timer = None
+    now = time.time()
+    due = dict((key, value) for key, value in self._pending.items() if self._notBefore.get(key, 0) <= now)
+    if due:
+      for key in due:
+        del self._pending[key]
+      self._sending = set(due)
+      self._inFlight = True
+      self.requests = self.requests + 1
+      self._executor.submit(self._send, due)
+    else:
+      self._schedule()
+    # one-shot timer
+    return False
+  
+  def _send(self, values):
+    # worker thread: never touch dbus or queue state here
+    started = time.perf_counter()
+    try:
+      self._source.setValues(values)
+      error = None
+    except Exception as e:
+      error = e
+    if self._stages is not None:
+      self._stages.since('write', started)
+    gobject.idle_add(self._onSent, values, error)
+  
+  def _onSent(self, values, error):
+    self._inFlight = False
+    self._sending = set()
+    now = time.time()
+    for key, value in values.items():
+      self._notBefore[key] = now + self._minInterval
+      if error is None:
+        self._sent[key] = (value, now)
+      else:
+        self._retry(key, value, now, error)
+    self._schedule()
+    return False
+  
+  def _retry(self, key, value, now, reason):
+    self._attempts[key] = self._attempts.get(key, 0) + 1
+    if key in self._pending:
+      # a newer value is already waiting
+      return
+    if self._attempts[key] > self._maxRetries:
+      self.failed = self.failed + 1
+      logHttp.warning("HTTP::go-eCharger parameter %s not set to %s: %s", key, value, reason)
+      return
+    self.retries = self.retries + 1
+    self._pending[key] = value
+    self._notBefore[key] = now + min(self._maxBackoff, self._minInterval * (2 ** self._attempts[key]))
+    logHttp.info("HTTP::Retry %s=%s in %.0f s (%s)", key, value, self._notBefore[key] - now, reason)
+  
+  def confirm(self, data):
+    now = time.time()
+    for key, (value, sent) in list(self._sent.items()):
+      if key not in data or str(data[key]) == str(value):
+        # keys the status does not report are taken as set
+        del self._sent[key]
+        self.confirmed = self.confirmed + 1
+      elif now - sent > self._confirmTimeout:
+        del self._sent[key]
+        self._retry(key, value, now, "not confirmed by status")
+    self._schedule()
+  
+  def flush(self):
+    # blocking, for shutdown when the GLib loop is gone
+    if self._pending:
+      try:
+        self._source.setValues(dict(self._pending))
+        self._pending.clear()
+      except Exception as e:
+        logHttp.warning("HTTP::go-eCharger writes lost at exit: %s", e)
+
+
+class MqttPushListener:
+  """Subscribe to the status the go-eCharger publishes over MQTT and hand it to the GLib loop.
+  
+  API v1 firmware publishes the whole document to <topic>/status, API v2 firmware one message per key
+  to <topic>/<key>. Messages are merged and delivered at most every minInterval seconds.
+  """
+  def __init__(self, host, port, topic, callback, minInterval=0.5):
+    if mqtt is None:
+      raise ImportError("paho-mqtt is required for MQTT push ingestion")
+    
+    self._topic = topic.rstrip('/')
+    self._callback = callback
+    self._minInterval = minInterval
+    
+    # written by the paho network thread, read from the GLib loop
+    self._lock = threading.Lock()
+    self._data = {}
+    self._scheduled = False
+    self._lastDelivered = 0
+    
+    self.messages = 0
+    self.deliveries = 0
+    self.lastMessage = 0
+    
+    if hasattr(mqtt, 'CallbackAPIVersion'):
+      self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    else:
+      self._client = mqtt.Client()
+    self._client.on_connect = self._onConnect
+    self._client.on_message = self._onMessage
+    self._client.connect_async(host, port)
+    self._client.loop_start()
+  
+  def _onConnect(self, client, userdata, *args):
+    logging.info("MQTT::Connected, subscribe to %s/#", self._topic)
+    client.subscribe(self._topic + '/#')
+  
+  def _onMessage(self, client, userdata, message):
+    key = message.topic[len(self._topic) + 1:]
+    try:
+      value = json.loads(message.payload)
+    except ValueError:
+      return
+    
+    with self._lock:
+      if key == 'status' and isinstance(value, dict):
+        self._data.update(value)
+      else:
+        self._data[key] = value
+      self.messages = self.messages + 1
+      self.lastMessage = time.time()
+      
+      if self._scheduled:
+        return
+      self._scheduled = True
+      delay = max(0, self._minInterval - (time.time() - self._lastDelivered))
+    gobject.timeout_add(int(delay * 1000), self._deliver)
+  
+  def _deliver(self):
+    with self._lock:
+      data = dict(self._data)
+      self._scheduled = False
+      self._lastDelivered = time.time()
+    
+    self.deliveries = self.deliveries + 1
+    self._callback(data)
+    # one-shot timeout source
+    return False
+  
+  def stop(self):
+    self._client.loop_stop()
+    self._client.disconnect()
+
+
+class AsyncStatusPoller:
+  """Fetch the go-eCharger status on worker threads and hand the result back to the GLib loop."""
+  def __init__(self, fetch, callback, maxInFlight=1, staleAfter=10.0, executor=None):
+    self._fetch = fetch
+    self._callback = callback
+    self._maxInFlight = max(1, maxInFlight)
+    self._staleAfter = staleAfter
+    # several chargers share the workers of one executor
+    self._executor = executor if executor is not None else ThreadPoolExecutor(max_workers=self._maxInFlight)
+    
+    # only touched from the GLib loop (poll/_deliver), no locking needed
+    self._inFlight = 0
+    self._sequence = 0
+    self._lastDelivered = 0
+    
+    self.latency = None
+    self.skipped = 0
+    self.dropped = 0
+  
+  def poll(self):
+    if self._inFlight >= self._maxInFlight:
+      self.skipped = self.skipped + 1
+      logHttp.debug("HTTP::Poll skipped, %s request(s) in flight", self._inFlight)
+      return False
+    
+    self._inFlight = self._inFlight + 1
+    self._sequence = self._sequence + 1
+    self._executor.submit(self._run, self._sequence, time.time())
+    return True
+  
+  def _run(self, sequence, started):
+    # worker thread: never touch dbus or service state here
+    try:
+      data = self._fetch()
+    except Exception as e:
+      logHttp.warning("HTTP::Poll failed: %s", e)
+      data = None
+    gobject.idle_add(self._deliver, sequence, started, time.time(), data)
+  
+  def _deliver(self, sequence, started, finished, data):
+    self._inFlight = self._inFlight - 1
+    
+    # a newer response was already processed or this one is too old to act on
+    if sequence < self._lastDelivered or time.time() - started > self._staleAfter:
+      self.dropped = self.dropped + 1
+      logHttp.debug("HTTP::Drop stale response #%s (%.0f ms)", sequence, (finished - started) * 1000)
+      return False
+    
+    self._lastDelivered = sequence
+    self.latency = finished - started
+    self._callback(data)
+    
+    # one-shot idle source
+    return False
+
+
+class PollScheduler:
+  """Call poll from the GLib loop with an interval (ms) that follows the state of the charger.
+  
+  No car (car 1) is polled every idle ms, a charging car (car 2) every charging ms and anything else, including
+  an unavailable charger, every connected ms. boost() polls every boost ms for the next boostDuration seconds,
+  e.g. to see the result of a write early. The GLib timer is only replaced when the interval changes.
+  """
+  def __init__(self, poll, idle, connected, charging, boost, boostDuration):
+    self._poll = poll
+    self._intervals = {1: idle, 2: charging}
+    self._connected = connected
+    self._boost = boost
+    self._boostDuration = boostDuration
+    self._boostUntil = 0
+    self._state = None
+    self._timer = None
+    self._running = False
+    
+    self.interval = None
+    self.reschedules = 0
+  
+  def start(self):
+    self._reschedule()
+  
+  def setState(self, car):
+    self._state = car
+    self._reschedule()
+  
+  def boost(self):
+    self._boostUntil = time.time() + self._boostDuration
+    self._reschedule()
+  
+  def _next(self):
+    interval = self._intervals.get(self._state, self._connected)
+    if time.time() < self._boostUntil:
+      interval = min(interval, self._boost)
+    return interval
+  
+  def _reschedule(self):
+    # a change during the poll is picked up by _run
+    if self._running or self._next() == self.interval:
+      return
+    if self._timer is not None:
+      gobject.source_remove(self._timer)
+    self._start(self._next())
+  
+  def _start(self, interval):
+    self.interval = interval
+    self.reschedules = self.reschedules + 1
+    self._timer = gobject.timeout_add(interval, self._run)
+  
+  def _run(self):
+    self._running = True
+    try:
+      self._poll()
+    except Exception as e:
+      logging.critical('Error at %s', '_poll', exc_info=e)
+    finally:
+      self._running = False
+    
+    # state changed or boost expired
+    interval = self._next()
+    if interval != self.interval:
+      self._start(interval)
+      return False
+    return True
+
+
+class PeriodicTask:
+  """Run a function every period ms from the GLib loop and watch its timing.
+  
+  A run overruns when it takes longer than the period. A run is late when it starts more than a period after it
+  was due, because the loop was busy with something else. Both are counted and logged.
+  """
+  def __init__(self, name, period, run):
+    self.name = name
+    self.period = period
+    self._run = run
+    self._due = None
+    
+    self.runs = 0
+    self.overruns = 0
+    self.late = 0
+  
+  def start(self):
+    self._due = time.monotonic() + self.period / 1000.0
+    gobject.timeout_add(self.period, self._tick)
+  
+  def _tick(self):
+    started = time.monotonic()
+    if started - self._due > self.period / 1000.0:
+      self.late = self.late + 1
+      logging.warning("Task %s started %.0f ms late", self.name, (started - self._due) * 1000)
+    
+    try:
+      self._run()
+    except Exception as e:
+      logging.critical('Error at %s', self.name, exc_info=e)
+    
+    finished = time.monotonic()
+    self.runs = self.runs + 1
+    if finished - started > self.period / 1000.0:
+      self.overruns = self.overruns + 1
+      logging.warning("Task %s took %.0f ms, longer than its period of %s ms", self.name, (finished - started) * 1000, self.period)
+    # GLib counts the next period from the dispatch of this run
+    self._due = started + self.period / 1000.0
+    return True
+
+
+class DbusPublisher:
+  """Collect the values of one update and publish the changed ones with a single ItemsChanged signal.
+  
+  Paths with a 'deadband' (absolute), 'relDeadband' (fraction of the last published value) or 'maxInterval' (s)
+  in their settings are only published when they moved past the deadband or the heartbeat interval is due.
+  """
+  def __init__(self, service, paths={}):
+    self._service = service
+    self._pending = {}
+    # velib's service context emits one ItemsChanged, older velib only knows per-path PropertiesChanged
+    self._batched = hasattr(service, '__enter__')
+    
+    self._filters = {}
+    for path, settings in paths.items():
+      if 'deadband' in settings or 'relDeadband' in settings or 'maxInterval' in settings:
+        self._filters[path] = (settings.get('deadband', 0), settings.get('relDeadband', 0), settings.get('maxInterval', None))
+    self._lastPublished = {}
+    
+    self.published = 0
+    self.signals = 0
+    self.avoided = 0
+    self.filtered = 0
+  
+  def _isDue(self, path, value, now):
+    deadband, relDeadband, maxInterval = self._filters[path]
+    last = self._service[path]
+    
+    if last is None or value is None or value == 0:
+      return True
+    if maxInterval is not None and now - self._lastPublished.get(path, 0) >= maxInterval:
+      return True
+    return abs(value - last) > max(deadband, relDeadband * abs(last))
+  
+  def __setitem__(self, path, value):
+    self._pending[path] = value
+  
+  def __getitem__(self, path):
+    if path in self._pending:
+      return self._pending[path]
+    return self._service[path]
+  
+  def commit(self):
+    now = time.time()
+    changes = []
+    for path, value in self._pending.items():
+      if self._service[path] == value:
+        continue
+      if path in self._filters:
+        if not self._isDue(path, value, now):
+          self.filtered = self.filtered + 1
+          continue
+        self._lastPublished[path] = now
+      changes.append((path, value))
+    
+    self.avoided = self.avoided + len(self._pending) - len(changes)
+    self._pending.clear()
+    
+    if not changes:
+      return 0
+    
+    if self._batched:
+      with self._service as service:
+        for path, value in changes:
+          service[path] = value
+      self.signals = self.signals + 1
+      self.avoided = self.avoided + len(changes) - 1
+    else:
+      for path, value in changes:
+        self._service[path] = value
+      self.signals = self.signals + len(changes)
+    
+    self.published = self.published + len(changes)
+    return len(changes)
+
+
+# D-Bus services read by the controller
+SERVICE_GRID = 'com.victronenergy.grid.mymeter'
+SERVICE_SETTINGS = 'com.victronenergy.settings'
+SERVICE_SYSTEM = 'com.victronenergy.system'
+SERVICE_VEBUS = 'com.victronenergy.vebus.ttyS4'
+SERVICE_VARTA = 'com.victronenergy.acsystem.VartaElement'
+
+
+class DbusValueCache:
+  """Local copy of values on other D-Bus services, kept up to date by their PropertiesChanged/ItemsChanged
+  signals like velib's DbusMonitor. Services that never sent a signal are polled with GetValue instead,
+  at most every pollInterval seconds.
+  """
+  def __init__(self, bus, signalling=(), pollInterval=1.0, backoff=2.0, backoffMax=300.0):
+    self._bus = bus
+    self._pollInterval = pollInterval
+    self._backoff = backoff
+    self._backoffMax = backoffMax
+    
+    self._values = {}     # (service, path) -> value, None if not available
+    self._updated = {}    # (service, path) -> time of the last update
+    self._objects = {}    # (service, path) -> proxy object
+    self._paths = {}      # service -> list of paths
+    self._breakers = {}   # service -> CircuitBreaker, no polls or writes while open
+    # services known to send signals for every change, the rest is polled until it proves otherwise
+    self._signalling = set(signalling)
+    
+    self._writing = set() # (service, path) with a SetValue in flight
+    self._waiting = {}    # (service, path) -> value to write once the one in flight returned
+    
+    self.reads = 0
+    self.polls = 0
+    self.writes = 0
+    self.coalesced = 0
+    self.signals = 0
+    self.rejected = 0
+  
+  def add(self, service, path):
+    key = (service, path)
+    if key in self._values:
+      return
+    
+    if service not in self._paths:
+      self._paths[service] = []
+      self._breakers[service] = CircuitBreaker("DBUS::%s" % (service), self._backoff, self._backoffMax)
+      self._subscribe(service)
+    self._paths[service].append(path)
+    self._values[key] = None
+    self._updated[key] = 0
+    self._poll(key)
+  
+  def _subscribe(self, service):
+    self._bus.add_signal_receiver(lambda changes, path=None: self._onPropertiesChanged(service, path, changes),
+                                  dbus_interface='com.victronenergy.BusItem', signal_name='PropertiesChanged',
+                                  bus_name=service, path_keyword='path')
+    self._bus.add_signal_receiver(lambda items: self._onItemsChanged(service, items),
+                                  dbus_interface='com.victronenergy.BusItem', signal_name='ItemsChanged',
+                                  bus_name=service, path='/')
+    self._bus.watch_name_owner(service, lambda owner: self._onNameOwnerChanged(service, owner))
+  
+  def _onPropertiesChanged(self, service, path, changes):
+    key = (service, path)
+    if key in self._values and 'Value' in changes:
+      self._breakers[service].success()
+      self._signalling.add(service)
+      self.signals = self.signals + 1
+      self._store(key, changes['Value'])
+  
+  def _onItemsChanged(self, service, items):
+    self._breakers[service].success()
+    self._signalling.add(service)
+    self.signals = self.signals + 1
+    for path, changes in items.items():
+      key = (service, str(path))
+      if key in self._values and 'Value' in changes:
+        self._store(key, changes['Value'])
+  
+  def _onNameOwnerChanged(self, service, owner):
+    # proxies are bound to the old owner, build new ones on next access
+    for path in self._paths.get(service, []):
+      self._objects.pop((service, path), None)
+    
+    if owner:
+      logging.info("DBUS::%s available", service)
+      # no need to wait for the backoff, probe right away
+      self._breakers[service].success()
+      for path in self._paths.get(service, []):
+        self._poll((service, path))
+    else:
+      paths = self._paths.get(service, [])
+      if any(self._values[(service, path)] is not None for path in paths):
+        logging.warning("DBUS::%s disappeared", service)
+      self._breakers[service].trip("no owner")
+      for path in paths:
+        self._values[(service, path)] = None
+  
+  def _store(self, key, value):
+    # velib sends an empty array for an invalid value
+    if isinstance(value, dbus.Array) and len(value) == 0:
+      value = None
+    self._values[key] = value
+    self._updated[key] = time.time()
+  
+  def _getObject(self, key):
+    if key not in self._objects:
+      self._objects[key] = self._bus.get_object(key[0], key[1], introspect=False)
+    return self._objects[key]
+  
+  def _poll(self, key):
+    breaker = self._breakers[key[0]]
+    if not breaker.allow():
+      return
+    self.polls = self.polls + 1
+    try:
+      self._store(key, self._getObject(key).GetValue())
+      breaker.success()
+    except Exception as e:
+      self._objects.pop(key, None)
+      self._values[key] = None
+      breaker.failure(e)
+  
+  def get(self, service, path):
+    key = (service, path)
+    self.reads = self.reads + 1
+    if service not in self._signalling and time.time() - self._updated[key] >= self._pollInterval:
+      self._poll(key)
+    
+    value = self._values[key]
+    if value is None:
+      raise LookupError("%s:%s not available" % (service, path))
+    return value
+  
+  def set(self, service, path, value, block=False):
+    # asynchronous unless asked otherwise, one write per path in flight, later values replace waiting ones
+    key = (service, path)
+    if not block and self._breakers[service].state == CircuitBreaker.OPEN:
+      # nobody there to take it, the next poll after the backoff reads the real value
+      self.rejected = self.rejected + 1
+      return
+    self._store(key, value)
+    if block:
+      self.writes = self.writes + 1
+      self._getObject(key).SetValue(value)
+    elif key in self._writing:
+      self.coalesced = self.coalesced + 1
+      self._waiting[key] = value
+    else:
+      self._write(key, value)
+  
+  def _write(self, key, value):
+    self.writes = self.writes + 1
+    self._writing.add(key)
+    self._getObject(key).SetValue(value, reply_handler=lambda result: self._onWritten(key),
+                                  error_handler=lambda error: self._onWriteFailed(key, value, error))
+  
+  def _onWritten(self, key):
+    self._writing.discard(key)
+    if key in self._waiting:
+      self._write(key, self._waiting.pop(key))
+  
+  def _onWriteFailed(self, key, value, error):
+    logging.warning("DBUS::SetValue %s:%s = %s failed: %s", key[0], key[1], value, error)
+    self._breakers[key[0]].failure(error)
+    self._objects.pop(key, None)
+    self._onWritten(key)
+    if key not in self._writing:
+      # the cache holds the value that was not written, read back the real one
+      self._poll(key)
+  
+  def age(self, service, path):
+    updated = self._updated.get((service, path), 0)
+    if not updated:
+      return None
+    return time.time() - updated
+  
+  def ages(self):
+    return [(service, path, self.age(service, path)) for (service, path) in sorted(self._values)]
+  
+  def health(self, service):
+    return self._breakers[service]
+
+
+class WindowStats:
+  """Statistics over the last `size` samples in a preallocated ring buffer, plus an EMA over all samples.
+  
+  add() and mean are O(1) and allocate nothing, min, max and percentile walk the window on request.
+  """
+  def __init__(self, size, alpha=None):
+    self._values = array('d', [0.0] * size)
+    self._size = size
+    # default EMA time constant is the window length
+    self._alpha = alpha if alpha is not None else 2.0 / (size + 1)
+    self.clear()
+  
+  def clear(self):
+    self._next = 0
+    self._sum = 0.0
+    self.count = 0
+    self.ema = None
+  
+  def add(self, value):
+    if self.count == self._size:
+      self._sum = self._sum - self._values[self._next]
+    else:
+      self.count = self.count + 1
+    self._values[self._next] = value
+    self._sum = self._sum + value
+    self._next = (self._next + 1) % self._size
+    self.ema = value if self.ema is None else self.ema + self._alpha * (value - self.ema)
+  
+  @property
+  def full(self):
+    return self.count == self._size
+  
+  @property
+  def mean(self):
+    return self._sum / self.count if self.count else 0.0
+  
+  def _window(self):
+    return self._values if self.count == self._size else self._values[:self.count]
+  
+  @property
+  def min(self):
+    return min(self._window()) if self.count else 0.0
+  
+  @property
+  def max(self):
+    return max(self._window()) if self.count else 0.0
+  
+  def percentile(self, p):
+    # nearest rank, p in 0..100
+    if not self.count:
+      return 0.0
+    values = sorted(self._window())
+    return values[min(self.count - 1, max(0, int(math.ceil(p / 100.0 * self.count)) - 1))]
+
+
+class LatencyHistogram:
+  """Counts of durations in fixed logarithmic buckets from 50 us to about 60 s, constant memory whatever the uptime.
+  
+  Percentiles are reported as the upper bound of their bucket (25 % resolution) but never above max, max as
+  measured. age() halves the counts, so older samples fade out, and lowers max to the bucket of the largest
+  sample left.
+  """
+  BOUNDS = [0.00005 * 1.25 ** i for i in range(64)]
+  
+  def __init__(self):
+    self._counts = array('L', [0] * (len(self.BOUNDS) + 1))
+    self._lock = threading.Lock()
+    self.count = 0
+    self.max = 0.0
+  
+  def add(self, seconds):
+    # also called from the HTTP worker threads
+    with self._lock:
+      self._counts[bisect_right(self.BOUNDS, seconds)] += 1
+      self.count = self.count + 1
+      if seconds > self.max:
+        self.max = seconds
+  
+  def age(self):
+    with self._lock:
+      for i in range(len(self._counts)):
+        self._counts[i] = self._counts[i] // 2
+      self.count = sum(self._counts)
+      # max follows the buckets, a bucket bound is never above the measured max
+      top = max([i for i, count in enumerate(self._counts) if count], default=None)
+      if top is None:
+        self.max = 0.0
+      elif top < len(self.BOUNDS):
+        self.max = min(self.max, self.BOUNDS[top])
+  
+  def percentile(self, p):
+    if not self.count:
+      return None
+    rank = max(1, int(math.ceil(p / 100.0 * self.count)))
+    total = 0
+    for i, count in enumerate(self._counts):
+      total = total + count
+      if total >= rank:
+        break
+    # the bucket of the max reports the max
+    if i == len(self.BOUNDS) or self.max < self.BOUNDS[i]:
+      return self.max
+    return self.BOUNDS[i]
+
+
+class StageTimer:
+  """One LatencyHistogram per named stage of the update."""
+  def __init__(self, stages):
+    self.stages = stages
+    self._histograms = dict((stage, LatencyHistogram()) for stage in stages)
+  
+  def add(self, stage, seconds):
+    self._histograms[stage].add(seconds)
+  
+  def since(self, stage, started):
+    # started from time.perf_counter()
+    self._histograms[stage].add(time.perf_counter() - started)
+  
+  def __getitem__(self, stage):
+    return self._histograms[stage]
+  
+  def age(self):
+    for histogram in self._histograms.values():
+      histogram.age()
+  
+  def summary(self):
+    # stage: p50/p95/max in ms
+    def _ms(seconds):
+      return '-' if seconds is None else '%.1f' % (seconds * 1000)
+    return ' '.join('%s: %s/%s/%s' % (stage, _ms(self[stage].percentile(50)), _ms(self[stage].percentile(95)),
+                                      _ms(self[stage].max if self[stage].count else None)) for stage in self.stages)
+
+
+class PhaseModel:
+  """Per-phase electrical state of a charger from the nrg vector, in site phase order (PhaseL1/SwitchL1L2).
+  
+  nrg holds U L1-L3, N (V), I L1-L3 (0.1 A), P L1-L3, N (0.1 kW), P total (0.01 kW) and the power factors
+  L1-L3, N (%). The power at a candidate current is predicted from voltage and power factor of the charging phases.
+  """
+  NOMINAL_VOLTAGE = 230.0
+  # lower bound of the control margin, roughly the noise of the grid meter
+  MIN_MARGIN = 50
+  # charger phase per site phase L1, L2, L3 for (PhaseL1, SwitchL1L2)
+  PHASE_ORDER = {(1, False): (0, 1, 2), (1, True): (0, 2, 1),
+                 (2, False): (1, 2, 0), (2, True): (1, 0, 2),
+                 (3, False): (2, 1, 0), (3, True): (2, 0, 1)}
+  
+  def __init__(self):
+    self.voltage = [self.NOMINAL_VOLTAGE] * 3
+    self.current = [0.0] * 3
+    self.power = [0.0] * 3
+    self.powerFactor = [1.0] * 3
+    self._order = self.PHASE_ORDER[(1, False)]
+    # site phases of the last charge, all three until one was seen
+    self._charging = (True, True, True)
+    self.phases = 3
+  
+  def update(self, nrg, phaseL1=1, switchL1L2=False):
+    self._order = self.PHASE_ORDER.get((phaseL1, bool(switchL1L2)), self.PHASE_ORDER[(1, False)])
+    for site, phase in enumerate(self._order):
+      if nrg[phase] > 0:
+        self.voltage[site] = float(nrg[phase])
+      self.current[site] = nrg[4 + phase] * 0.1
+      self.power[site] = nrg[7 + phase] * 0.1 * 1000
+      # the power factor is only meaningful while current flows
+      powerFactor = nrg[12 + phase] / 100.0
+      if self.current[site] > 1.0 and 0 < powerFactor <= 1:
+        self.powerFactor[site] = powerFactor
+    
+    charging = tuple(phaseCurrent > 1.0 for phaseCurrent in self.current)
+    if any(charging):
+      self._charging = charging
+      self.phases = sum(charging)
+  
+  def _sites(self, phases):
+    if phases is None or phases == self.phases:
+      return [site for site in range(3) if self._charging[site]]
+    if phases == 1:
+      # a charger forced to one phase charges on its own L1
+      return [self._order.index(0)]
+    return [0, 1, 2]
+  
+  def wattsPerAmp(self, phases=None):
+    return sum(self.voltage[site] * self.powerFactor[site] for site in self._sites(phases))
+  
+  def predict(self, current, phases=None):
+    return current * self.wattsPerAmp(phases)
+  
+  def margin(self, phases=None):
+    # half a current step around the target is the narrowest band that does not toggle between two steps
+    return max(self.MIN_MARGIN, self.wattsPerAmp(phases) / 2.0)
+
+
+# site readings of the last measurement, in the argument order of _updateBattery
+SiteValues = namedtuple('SiteValues', ['gridPower', 'gridGridSetPoint', 'powerBattery', 'powerBatteryExt', 'powerBatteryMaxCharge',
+                                       'powerBatteryMaxDischarge', 'powerBatteryMaxChargeExt', 'powerBatteryMaxDischargeExt',
+                                       'socBattery', 'socBatteryExt', 'socBatteryLimit'])
+PlanSlot = namedtuple('PlanSlot', ['start', 'end', 'pv', 'price', 'nightMode', 'hoursToPv', 'evCurrent',
+                                   'maxChargeExt', 'maxDischarge', 'gridSetPoint'])
+
+
+class ChargingScheduler:
+  """Plan of the next 24 h in fixed slots from a local PV forecast and an optional tariff file.
+  
+  The plan is rebuilt every ReplanInterval and whenever a file changed, an update only looks up its slot.
+  Slots with a forecast below NightPvThreshold are night slots with the NIGHTMODE limits. The cheapest CheapHours
+  of them charge the EV from the grid with ChargeCurrent, keep the battery from discharging and charge the Varta
+  with ChargeExtPower, the grid set-point is raised by that power. Slots with PV plan no battery limits.
+  """
+  TIMEZONE = pytz.timezone("Europe/Berlin")
+  
+  def __init__(self, settings, nightMode):
+    self._settings = None
+    self._nightMode = None
+    self._mtimes = None
+    self._forecast = []
+    self._tariff = []
+    self._starts = []
+    self.plan = []
+    self.plans = 0
+    self.errors = 0
+    self.configure(settings, nightMode)
+  
+  def configure(self, settings, nightMode):
+    if settings == self._settings and nightMode == self._nightMode:
+      return
+    self._settings = settings
+    self._nightMode = nightMode
+    self._mtimes = None
+    self.replan()
+  
+  @classmethod
+  def _parseTime(cls, value):
+    # unix time or ISO 8601, local time if no offset is given
+    try:
+      return float(value)
+    except ValueError:
+      pass
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+      parsed = cls.TIMEZONE.localize(parsed)
+    return parsed.timestamp()
+  
+  @classmethod
+  def readSeries(cls, path, column):
+    # CSV with the header time,<column> or JSON, either [{"time": ..., "<column>": ...}] or {"<time>": value}
+    if path.endswith('.json'):
+      with open(path) as f:
+        data = json.load(f)
+      if isinstance(data, dict):
+        rows = list(data.items())
+      else:
+        rows = [(row['time'], row[column]) for row in data]
+    else:
+      with open(path, newline='') as f:
+        rows = [(row['time'], row[column]) for row in csv.DictReader(f)]
+    return sorted((cls._parseTime(str(when)), float(value)) for when, value in rows)
+  
+  def _load(self):
+    paths = [path for path in (self._settings.forecastFile, self._settings.tariffFile) if path]
+    mtimes = tuple(os.stat(path).st_mtime for path in paths)
+    if mtimes == self._mtimes:
+      return
+    self._forecast = self.readSeries(self._settings.forecastFile, 'pv')
+    self._tariff = self.readSeries(self._settings.tariffFile, 'price') if self._settings.tariffFile else []
+    self._mtimes = mtimes
+  
+  @staticmethod
+  def _valueAt(series, times, when):
+    # step function, the last value at or before the slot start
+    index = bisect_right(times, when) - 1
+    return series[index][1] if index >= 0 else None
+  
+  def replan(self, now=None):
+    try:
+      self._load()
+    except (OSError, ValueError, KeyError) as e:
+      self.errors = self.errors + 1
+      logging.error("Schedule::Forecast not readable, keep the previous plan: %s", e)
+      return True
+    
+    now = time.time() if now is None else now
+    length = self._settings.slotMinutes * 60
+    first = now - now % length
+    count = int(24 * 3600 / length)
+    forecastTimes = [when for when, value in self._forecast]
+    tariffTimes = [when for when, value in self._tariff]
+    
+    starts = [first + index * length for index in range(count)]
+    pv = [self._valueAt(self._forecast, forecastTimes, start) for start in starts]
+    price = [self._valueAt(self._tariff, tariffTimes, start) for start in starts]
+    night = [value is not None and value < self._settings.nightPvThreshold for value in pv]
+    
+    # hours from a slot to the next one with PV, from the back of the plan
+    hoursToPv = [None] * count
+    nextPv = None
+    for index in range(count - 1, -1, -1):
+      if pv[index] is not None and not night[index]:
+        nextPv = starts[index]
+      hoursToPv[index] = (nextPv - starts[index]) / 3600.0 if nextPv is not None else None
+    
+    cheap = set()
+    if self._settings.cheapHours > 0:
+      candidates = sorted((price[index], index) for index in range(count) if night[index] and price[index] is not None)
+      cheap = set(index for value, index in candidates[:int(self._settings.cheapHours * 60 / self._settings.slotMinutes)])
+    
+    self.plan = [self._slot(starts[index], starts[index] + length, pv[index], price[index], night[index], hoursToPv[index],
+                            index in cheap)
+                 for index in range(count)]
+    self._starts = starts
+    self.plans = self.plans + 1
+    logging.debug("Schedule::Plan from %s: %s night slots, %s grid charging slots", datetime.fromtimestamp(first), sum(night), len(cheap))
+    # keep the GLib timer
+    return True
+  
+  def _slot(self, start, end, pv, price, night, hoursToPv, cheap):
+    nightMode = self._nightMode
+    if not night:
+      # the usual battery control applies outside night mode
+      maxChargeExt = maxDischarge = gridSetPoint = None
+    elif cheap:
+      # the grid is cheap: the battery keeps its charge for the expensive slots, the Varta charges from the grid
+      chargeExt = max(nightMode.maxExternalCharge, self._settings.chargeExtPower)
+      maxChargeExt = chargeExt
+      maxDischarge = 0
+      gridSetPoint = nightMode.gridSetPoint + chargeExt - nightMode.maxExternalCharge
+    else:
+      maxChargeExt = nightMode.maxExternalCharge
+      maxDischarge = nightMode.maxDischarge
+      gridSetPoint = nightMode.gridSetPoint
+    return PlanSlot(start = start, end = end, pv = pv, price = price, nightMode = night, hoursToPv = hoursToPv,
+                    evCurrent = self._settings.chargeCurrent if cheap else None,
+                    maxChargeExt = maxChargeExt, maxDischarge = maxDischarge, gridSetPoint = gridSetPoint)
+  
+  def lookup(self, now=None):
+    now = time.time() if now is None else now
+    index = bisect_right(self._starts, now) - 1
+    if index < 0 or now >= self.plan[index].end:
+      return None
+    return self.plan[index]
+
+
+class SiteLoadBalancer:
+  """Split the PV surplus and the main fuse of the site across all chargers in one pass per tick.
+  
+  Every charger reports its state after an update and reads back its budget. Chargers in PV mode are served by
+  priority (lower first), chargers of the same priority share equally. A share below the 6 A minimum of a charger
+  goes to the others of its group, so a small surplus charges one car instead of none.
+  """
+  MIN_CURRENT = 6
+  VOLTAGE = PhaseModel.NOMINAL_VOLTAGE
+  
+  def __init__(self, dbusValues, mainFuse=0, staleAfter=10.0):
+    self._dbusValues = dbusValues
+    self._mainFuse = mainFuse
+    self._staleAfter = staleAfter
+    self._chargers = {}
+    self._allocations = {}
+    
+    # same battery allowance as DbusGoeChargerService._updatePVsurplusCharging
+    self._minPowerLoadBatteryDuringCharging = 500
+    self._minPowerLoadBatteryDuringChargingExt = 500
+    self._maxPowerUnloadBatteryDuringCharging = 0
+    self._maxPowerUnloadBatteryDuringChargingExt = 0
+    
+    self.surplus = None
+    self.ticks = 0
+  
+  def register(self, name, priority):
+    self._chargers[name] = {'priority': priority, 'time': 0, 'pvMode': False, 'power': 0, 'wattsPerAmp': 3 * self.VOLTAGE, 'charging': False, 'maxCurrent': 0}
+    self._allocations[name] = (0, 0)
+  
+  def setMainFuse(self, mainFuse):
+    self._mainFuse = mainFuse
+  
+  def report(self, name, pvMode, power, wattsPerAmp, charging, maxCurrent):
+    charger = self._chargers[name]
+    charger['time'] = time.time()
+    charger['pvMode'] = pvMode
+    charger['power'] = power
+    charger['wattsPerAmp'] = wattsPerAmp
+    charger['charging'] = charging
+    charger['maxCurrent'] = maxCurrent
+  
+  def allocation(self, name):
+    # (power in W, current in A) this charger may draw
+    return self._allocations[name]
+  
+  def _minPower(self, charger):
+    return self.MIN_CURRENT * charger['wattsPerAmp']
+  
+  def _maxPower(self, charger):
+    return charger['maxCurrent'] * charger['wattsPerAmp']
+  
+  def tick(self):
+    self.ticks = self.ticks + 1
+    try:
+      gridPower = self._dbusValues.get(SERVICE_GRID, '/Ac/Power')
+      powerBattery = self._dbusValues.get(SERVICE_VEBUS, '/Dc/0/Power')
+    except LookupError:
+      # keep the last budgets until the grid meter and the battery are back
+      return True
+    try:
+      powerBatteryExt = self._dbusValues.get(SERVICE_VARTA, '/Ac/In/1/P')
+    except LookupError:
+      powerBatteryExt = 0
+    
+    now = time.time()
+    managed = [(name, charger) for name, charger in sorted(self._chargers.items())
+               if charger['pvMode'] and now - charger['time'] < self._staleAfter]
+    
+    # grid without the managed chargers, less what the batteries may keep charging
+    power = gridPower - sum(charger['power'] for name, charger in managed)
+    siteLoad = max(0, power)
+    if powerBattery > 0:
+      power = power - (powerBattery - self._minPowerLoadBatteryDuringCharging)
+    if powerBatteryExt > 0:
+      power = power - (powerBatteryExt - self._minPowerLoadBatteryDuringChargingExt)
+    if powerBattery < -self._maxPowerUnloadBatteryDuringCharging:
+      power = power + (self._maxPowerUnloadBatteryDuringCharging - powerBattery)
+    if powerBatteryExt < -self._maxPowerUnloadBatteryDuringChargingExt:
+      power = power + (self._maxPowerUnloadBatteryDuringChargingExt - powerBatteryExt)
+    self.surplus = max(0, -power)
+    
+    # the main fuse caps the sum of the charger currents, household load assumed balanced over three phases
+    fuseLeft = None
+    if self._mainFuse > 0:
+      fuseLeft = self._mainFuse - siteLoad / (self.VOLTAGE * 3.0)
+    
+    allocations = dict((name, (0, 0)) for name in self._chargers)
+    allocations.update(self._split(managed, self.surplus, fuseLeft))
+    self._allocations = allocations
     
-    self._getLoggingLevel(config)
+    logWallbox.debug("WALLBOX::Balancer surplus = %s W allocations = %s", int(self.surplus), allocations)
+    return True
+  
+  @staticmethod
+  def _fill(caps, amount):
+    # water-filling: shares capped below the equal share hand the rest to the others
+    shares = {}
+    for index, (name, cap) in enumerate(sorted(caps, key=lambda item: item[1])):
+      share = min(cap, amount / (len(caps) - index))
+      shares[name] = share
+      amount = amount - share
+    return shares
+  
+  def _split(self, managed, surplus, fuseLeft=None):
+    allocations = {}
+    for priority in sorted(set(charger['priority'] for name, charger in managed)):
+      # charging cars first, so a short budget or fuse does not toggle a running session
+      group = sorted([(name, charger) for name, charger in managed if charger['priority'] == priority],
+                     key=lambda item: not item[1]['charging'])
+      while len(group) > 1 and (surplus / len(group) < max(self._minPower(charger) for name, charger in group)
+                                or fuseLeft is not None and fuseLeft / len(group) < self.MIN_CURRENT):
+        group.pop()
+      
+      powers = self._fill([(name, self._maxPower(charger)) for name, charger in group], surplus)
+      wanted = dict((name, min(powers[name] / charger['wattsPerAmp'], charger['maxCurrent'])) for name, charger in group)
+      currents = wanted
+      if fuseLeft is not None:
+        currents = self._fill(list(wanted.items()), fuseLeft)
+      
+      for name, charger in group:
+        current = int(currents[name])
+        if current < self.MIN_CURRENT:
+          # nothing used, the rest goes to the next priority
+          continue
+        budget = powers[name]
+        if currents[name] < wanted[name]:
+          # held back by the fuse
+          budget = current * charger['wattsPerAmp']
+        allocations[name] = (int(budget), current)
+        surplus = surplus - budget
+        if fuseLeft is not None:
+          fuseLeft = fuseLeft - current
+    return allocations
+
+
+class Recorder:
+  """Append one fixed-size binary record per update to a size-capped, rotating file.
+  
+  Records are buffered in RAM and written in blocks every flushInterval seconds to spare the flash.
+  A file starts with MAGIC and a JSON header naming the struct format and the fields.
+  """
+  MAGIC = b'GOEREC\x01\n'
+  # unknown values are NaN for floats and 255 for bytes
+  FIELDS = (('time', 'd'), ('gridPower', 'f'), ('powerBattery', 'f'), ('socBattery', 'f'), ('powerBatteryExt', 'f'),
+            ('socBatteryExt', 'f'), ('powerWallbox', 'f'), ('amp', 'B'), ('alw', 'B'), ('car', 'B'),
+            ('newCurrent', 'B'), ('setCurrent', 'B'), ('startStop', 'B'), ('maxCharge', 'f'), ('maxDischarge', 'f'),
+            ('maxChargeExt', 'f'), ('maxDischargeExt', 'f'), ('gridSetPoint', 'f'), ('nightMode', 'B'))
+  FORMAT = '<' + ''.join(fmt for name, fmt in FIELDS)
+  Record = namedtuple('Record', [name for name, fmt in FIELDS])
+  
+  def __init__(self, path, maxFileSize=4*1024*1024, maxFiles=4, flushInterval=60.0, bufferSize=16*1024):
+    self._path = path
+    self._maxFileSize = maxFileSize
+    self._maxFiles = max(1, maxFiles)
+    self._flushInterval = flushInterval
+    self._bufferSize = bufferSize
+    self._struct = struct.Struct(self.FORMAT)
+    
+    self._buffer = bytearray()
+    self._lastFlush = time.time()
+    self.records = 0
+    self.rotations = 0
+  
+  @classmethod
+  def header(cls):
+    info = json.dumps({'format': cls.FORMAT, 'fields': [name for name, fmt in cls.FIELDS]}).encode('utf-8')
+    return cls.MAGIC + struct.pack('<H', len(info)) + info
+  
+  def append(self, *values):
+    self._buffer += self._struct.pack(*values)
+    self.records = self.records + 1
+    if len(self._buffer) >= self._bufferSize or time.time() - self._lastFlush >= self._flushInterval:
+      self.flush()
+  
+  def flush(self):
+    self._lastFlush = time.time()
+    if not self._buffer:
+      return
+    
+    try:
+      size = os.path.getsize(self._path)
+    except OSError:
+      size = 0
+    if size and size + len(self._buffer) > self._maxFileSize:
+      self._rotate()
+      size = 0
+    
+    try:
+      with open(self._path, 'ab') as f:
+        if not size:
+          f.write(self.header())
+        f.write(self._buffer)
+    except (IOError, OSError) as e:
+      logging.error("Recorder: writing %s failed: %s", self._path, e)
+    del self._buffer[:]
+  
+  def _rotate(self):
+    # recording -> recording.1 -> ... -> recording.<maxFiles-1>, the oldest is dropped
+    for index in range(self._maxFiles - 1, 0, -1):
+      source = self._path if index == 1 else "%s.%d" % (self._path, index - 1)
+      if os.path.exists(source):
+        os.rename(source, "%s.%d" % (self._path, index))
+    if self._maxFiles == 1 and os.path.exists(self._path):
+      os.remove(self._path)
+    self.rotations = self.rotations + 1
+  
+  @classmethod
+  def read(cls, path):
+    with open(path, 'rb') as f:
+      if f.read(len(cls.MAGIC)) != cls.MAGIC:
+        raise ValueError("%s is no recording" % (path))
+      length = struct.unpack('<H', f.read(2))[0]
+      info = json.loads(f.read(length).decode('utf-8'))
+      body = f.read()
+    
+    record = struct.Struct(info['format'])
+    Record = namedtuple('Record', info['fields'])
+    usable = len(body) - len(body) % record.size
+    for values in record.iter_unpack(body[:usable]):
+      yield Record(*values)
+
+
+class MetricsExporter:
+  """Counters and gauges in the Prometheus text format on http://<address>:<port>/metrics.
+  
+  The text is rendered on the GLib loop every `interval` seconds from the collectors, the server thread only
+  hands out the last rendering, so a scrape never waits for or touches the control loop.
+  """
+  CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+  
+  def __init__(self, address, port, interval=10.0):
+    self._collectors = []
+    self._body = b''
+    self.scrapes = 0
+    
+    exporter = self
+    
+    class MetricsHandler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+          self.send_error(404)
+          return
+        body = exporter._body
+        exporter.scrapes = exporter.scrapes + 1
+        self.send_response(200)
+        self.send_header('Content-Type', exporter.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+      
+      def log_message(self, format, *args):
+        logHttp.debug("HTTP::Metrics " + format, *args)
+    
+    self._server = ThreadingHTTPServer((address, port), MetricsHandler)
+    self._server.daemon_threads = True
+    self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+    self._thread.start()
+    gobject.timeout_add(int(interval * 1000), self.render)
+  
+  def register(self, collect):
+    # collect() returns (name, type, help, labels, value) tuples, value None leaves the sample out
+    self._collectors.append(collect)
+  
+  @staticmethod
+  def _labels(labels):
+    if not labels:
+      return ''
+    def _escape(value):
+      return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('%s="%s"' % (key, _escape(value)) for key, value in sorted(labels.items())) + '}'
+  
+  @staticmethod
+  def _value(value):
+    value = float(value)
+    if math.isnan(value):
+      return 'NaN'
+    if math.isinf(value):
+      return '+Inf' if value > 0 else '-Inf'
+    if value.is_integer():
+      return '%d' % (value)
+    return repr(value)
+  
+  def render(self):
+    # one HELP and TYPE per metric name, the samples of all collectors below
+    families = {}
+    for collect in self._collectors:
+      try:
+        samples = collect()
+      except Exception as e:
+        logging.error("Metrics collection failed: %s", e)
+        continue
+      for name, kind, description, labels, value in samples:
+        if value is None:
+          continue
+        family = families.setdefault(name, (kind, description, []))
+        family[2].append('%s%s %s' % (name, self._labels(labels), self._value(value)))
     
-    deviceinstance = int(config['DEFAULT']['Deviceinstance'])
-    hardwareVersion = int(config['DEFAULT']['HardwareVersion'])
-    guiname = config['DEFAULT']['Name'];
-    self._SetL1 = config['DEFAULT'].getint('PhaseL1',1);
-    self._SwitchL2L3 = config['DEFAULT'].getboolean('SwitchL1L2',False);
+    lines = []
+    for name, (kind, description, samples) in families.items():
+      lines.append('# HELP %s %s' % (name, description))
+      lines.append('# TYPE %s %s' % (name, kind))
+      lines.extend(samples)
+    self._body = ('\n'.join(lines) + '\n').encode('utf-8')
+    return True
+  
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+
+class DbusGoeChargerService:
+  """One go-eCharger on D-Bus. Only the primary charger of a process controls the batteries and the grid set-point."""
+  MIN_CURRENT = 6
+  # timed stages, published as /Debug/Latency/<Stage>/P50, P95 and Max in ms
+  STAGES = ('fetch', 'parse', 'dbus', 'battery', 'pv', 'nightmode', 'publish', 'write', 'update')
+  # status keys that matter besides nrg currents and powers, voltages alone do not wake up an idle charger
+  FINGERPRINT_KEYS = ('amp', 'ama', 'alw', 'car', 'ast', 'eto', 'tmp')
+  # s between two full updates of an idle charger
+  IDLE_REFRESH = 30
+  # W above the three phase minimum before a charger switched to one phase goes back to three
+  PHASE_SWITCH_HYSTERESIS = 500
+  # s a forced phase mode is trusted over a measurement that does not show it yet
+  PHASE_SWITCH_TIMEOUT = 120
+  # s after the end of a charge before the charger may start again, s a started charge may show status 3
+  RESTART_AFTER = 60*60*6
+  FINISH_LOAD_AFTER = 30
+  # dependencies besides the charger, published as /Health/<Name>
+  HEALTH_SERVICES = (('GridMeter', SERVICE_GRID), ('Vebus', SERVICE_VEBUS), ('Settings', SERVICE_SETTINGS), ('Varta', SERVICE_VARTA))
+  
+  def __init__(self, servicename, paths, config, chargerName, dbusValues, executor=None, bus=None, primary=True, balancer=None, scheduler=None, productname='go-eCharger', connection='go-eCharger HTTP JSON service'):
+    self._config = config
+    self._chargerName = chargerName
+    self._primary = primary
+    self._balancer = balancer
+    self._scheduler = scheduler
+    self._applySettings(self._config.settings)
+    settings = self._settings
+    charger = self._charger
     
-    self._DisableDischargeAtPower = config['LOAD'].getint('DisableDischargeAtPower',None)
-    self._DisableExternalDischargeAtPower = config['LOAD'].getint('DisableExternalDischargeAtPower',None)
+    deviceinstance = charger.deviceinstance
+    hardwareVersion = charger.hardwareVersion
+    guiname = charger.guiName
 
     self._nightMode = False;
-    self._nM_StartHour = config['NIGHTMODE'].getint('StartHour',18)
-    self._nM_EndHour = config['NIGHTMODE'].getint('EndHour',6)
-    self._nM_MaxExternalSOC = config['NIGHTMODE'].getfloat('MaxExternalSOC',50)
-    self._nM_MinExternalSOC = config['NIGHTMODE'].getfloat('MinExternalSOC',20)
-    self._nM_MaxExternalCharge = config['NIGHTMODE'].getfloat('MaxExternalCharge',0)
-    self._nM_GridSetPoint = config['NIGHTMODE'].getfloat('GridSetPoint',50)
-    self._nM_MaxDischarge = config['NIGHTMODE'].getfloat('MaxDischarge',50)
-    
-    self._dbusservice = VeDbusService("{}.http_{:02d}".format(servicename, deviceinstance),register=False)
+    
+    # latency per stage of the update, the HTTP stages are timed on the worker threads
+    self._stages = StageTimer(self.STAGES)
+    self._profile = None
+    
+    # an unreachable charger is probed with backoff instead of waiting out the timeout on every poll,
+    # the keep-alive session already retries a reset connection once, so a single failure may be a glitch
+    self._chargerHealth = CircuitBreaker("HTTP::go-eCharger %s" % (charger.host), settings.default.backoff, settings.default.backoffMax, threshold=2, logger=logHttp)
+    # one keep-alive connection pool for all requests to this charger
+    self._http = ChargerHttpSession(settings.onPremise.poolSize, settings.onPremise.connectTimeout, settings.onPremise.readTimeout, self._chargerHealth)
+    if charger.apiVersion == 2:
+       self._source = GoeChargerApiV2(self._http, charger, self._stages)
+    else:
+       self._source = GoeChargerApiV1(self._http, charger, self._stages)
+    # writes leave the control loop through a coalescing queue
+    self._commands = ChargerCommandQueue(self._source, executor, settings.onPremise.writeInterval, settings.onPremise.writeRetries, settings.onPremise.confirmTimeout,
+                                         stages=self._stages)
+    
+    # several services in one process need a bus connection each, velib exports '/' on every connection
+    if bus is not None:
+       self._dbusservice = VeDbusService("{}.http_{:02d}".format(servicename, deviceinstance), bus=bus, register=False)
+    else:
+       self._dbusservice = VeDbusService("{}.http_{:02d}".format(servicename, deviceinstance), register=False)
     self._paths = paths
     
-    logging.debug("%s /DeviceInstance = %d" % (servicename, deviceinstance))
+    logging.debug("%s /DeviceInstance = %d", servicename, deviceinstance)
     '''
     paths_wo_unit = [
       '/Status'  # value 'car' 1: charging station ready, no vehicle 2: vehicle loads 3: Waiting for vehicle 4: Charge finished, vehicle still connected
@@ -80,6 +2061,24 @@ class DbusGoeChargerService:
     self._dbusservice.add_path('/UpdateIndex', 0)
    
     self._dbusservice.add_path('/Position',1)
+    
+    # measured duration of the last /status request in ms
+    self._dbusservice.add_path('/Debug/PollLatency', None, gettextcallback=lambda p, v: (str(v) + 'ms'))
+    for stage in self.STAGES:
+       for statistic in ('P50', 'P95', 'Max'):
+          self._dbusservice.add_path('/Debug/Latency/%s/%s' % (stage.capitalize(), statistic), None, gettextcallback=lambda p, v: (str(v) + 'ms'))
+    
+    # state of the dependencies, 0 ok, 1 unavailable, 2 probing
+    _health = lambda p, v: CircuitBreaker.STATES.get(v, str(v))
+    self._dbusservice.add_path('/Health/Charger', CircuitBreaker.CLOSED, gettextcallback=_health)
+    for name, service in self.HEALTH_SERVICES:
+       self._dbusservice.add_path('/Health/%s' % (name), CircuitBreaker.CLOSED, gettextcallback=_health)
+    
+    # share of the PV surplus and the main fuse assigned by the site balancer
+    if self._balancer is not None:
+       self._balancer.register(chargerName, charger.priority)
+       self._dbusservice.add_path('/Allocation/Power', 0, gettextcallback=lambda p, v: (str(v) + 'W'))
+       self._dbusservice.add_path('/Allocation/Current', 0, gettextcallback=lambda p, v: (str(v) + 'A'))
  
     # add paths without units
     '''
@@ -93,42 +2092,34 @@ class DbusGoeChargerService:
         path, settings['initial'], gettextcallback=settings['textformat'], writeable=True, onchangecallback=self._handlechangedvalue)
 
     self._dbusservice.register()
+    
+    # measurement paths are collected per update and published at once
+    self._publisher = DbusPublisher(self._dbusservice, self._paths)
 
-    bus = dbus.SystemBus()
-    #bus.get_object('com.victronenergy.system', '/Ac/In/0/Servicename')
-    try:
-        self._powerGrid = bus.get_object('com.victronenergy.grid.mymeter', '/Ac/Power')
-    except Exception:
-       self._powerGrid = None;
-    self._gridGridSetPoint = bus.get_object('com.victronenergy.settings', '/Settings/CGwacs/AcPowerSetPoint')
-    self._gridGridSetPoint_reset = self._gridGridSetPoint.GetValue()
-    self._gridGridSetPoint_last = self._gridGridSetPoint_reset;
+    # values of other services are cached and kept up to date by their change signals, shared by all chargers
+    self._dbusValues = dbusValues
     
+    self._gridGridSetPoint_reset = self._dbusValues.get(SERVICE_SETTINGS, '/Settings/CGwacs/AcPowerSetPoint')
+    self._gridGridSetPoint_last = self._gridGridSetPoint_reset;
     
-    self._powerBattery = bus.get_object('com.victronenergy.vebus.ttyS4', '/Dc/0/Power')
-    self._powerBatteryMaxCharge = bus.get_object('com.victronenergy.settings', '/Settings/CGwacs/MaxChargePower')
-    self._powerBatteryMaxCharge_reset = self._powerBatteryMaxCharge.GetValue()
+    self._powerBatteryMaxCharge_reset = self._dbusValues.get(SERVICE_SETTINGS, '/Settings/CGwacs/MaxChargePower')
     self._powerBatteryMaxCharge_last = self._powerBatteryMaxCharge_reset;
-    self._powerBatteryMaxDischarge = bus.get_object('com.victronenergy.settings', '/Settings/CGwacs/MaxDischargePower')
-    self._powerBatteryMaxDischarge_reset = self._powerBatteryMaxDischarge.GetValue()
+    self._powerBatteryMaxDischarge_reset = self._dbusValues.get(SERVICE_SETTINGS, '/Settings/CGwacs/MaxDischargePower')
     self._powerBatteryMaxDischarge_last = self._powerBatteryMaxDischarge_reset;
-    self._socBattery = bus.get_object('com.victronenergy.vebus.ttyS4', '/Soc')
-    self._socLimit = bus.get_object('com.victronenergy.system', '/Control/ActiveSocLimit')
     
+    self._vartaConnected = False
+    self._powerBatteryMaxChargeExt_reset = None
+    self._powerBatteryMaxChargeExt_last = None
+    self._powerBatteryMaxDischargeExt_reset = None
+    self._powerBatteryMaxDischargeExt_last = None
     try:
-       self._powerBatteryExt = bus.get_object('com.victronenergy.acsystem.VartaElement', '/Ac/In/1/P')
-       self._powerBatteryMaxChargeExt = bus.get_object('com.victronenergy.acsystem.VartaElement', '/Ac/In/1/CurrentLimit')
-       self._powerBatteryMaxChargeExt_reset = self._powerBatteryMaxChargeExt.GetValue()
+       self._powerBatteryMaxChargeExt_reset = self._dbusValues.get(SERVICE_VARTA, '/Ac/In/1/CurrentLimit')
        self._powerBatteryMaxChargeExt_last = self._powerBatteryMaxChargeExt_reset;
-       self._powerBatteryMaxDischargeExt = bus.get_object('com.victronenergy.acsystem.VartaElement', '/Ac/Out/CurrentLimit')
-       self._powerBatteryMaxDischargeExt_reset = self._powerBatteryMaxDischargeExt.GetValue()
+       self._powerBatteryMaxDischargeExt_reset = self._dbusValues.get(SERVICE_VARTA, '/Ac/Out/CurrentLimit')
        self._powerBatteryMaxDischargeExt_last = self._powerBatteryMaxDischargeExt_reset;
-       self._socBatteryExt = bus.get_object('com.victronenergy.acsystem.VartaElement', '/Soc')
-    except Exception:
-       self._powerBatteryExt = None;
-       self._powerBatteryMaxChargeExt = None;
-       self._powerBatteryMaxDischargeExt = None;
-       self._socBatteryExt = None;
+       self._vartaConnected = True
+    except LookupError:
+       logging.warning("%s not available", SERVICE_VARTA)
        
     #Charge/Invert Internal/External Battery
     self._maxPowerUnloadBattery = 0
@@ -144,149 +2135,306 @@ class DbusGoeChargerService:
     self._enableRestart = True
     self._finishLoadCounter = 0
     self._restartCounter = 0
-    self._restartCounterLimit = 60*60*6
+    # both count steps of the PV control, which runs every PvInterval ms
+    self._restartCounterLimit = self.RESTART_AFTER * 1000 // self._settings.default.pvInterval
+    self._finishLoadCounterLimit = max(1, self.FINISH_LOAD_AFTER * 1000 // self._settings.default.pvInterval)
     
-    self._powerWallboxAvg = 0
-    self._powerOverloadAvg = 0
-    self._powerUnderloadAvg = 0
+    # sliding windows of the PV controller, the surplus/deficit windows hold the current streak
+    self._powerWallbox = WindowStats(30)
+    self._powerOverload = WindowStats(30)
+    self._powerUnderload = WindowStats(30)
     
     self._lastStatus = 0
-    self._pvOverloadCount = 0
-    self._pvUnderloadCount = 0
-    self._pvCurrentCount = 0;
     self._lastNumberOfPhases = 3
+    self._phaseModel = PhaseModel()
+    # phases forced through psm, None until the service switched them
+    self._phaseMode = None
+    self._phaseSwitched = 0
     self._lastCurrentAvg = 0
     self._waitForDisconnect = False
     
-    self._powerBatteryAvg = 0
-    self._powerBatteryExtAvg = 0
-    self._gridPowerAvg = 0
+    # sliding windows of the battery controller, the measurements of one battery period
+    batterySamples = max(1, int(round(self._settings.default.batteryInterval / float(self._settings.default.updateInterval))))
+    self._powerBattery = WindowStats(batterySamples)
+    self._powerBatteryExt = WindowStats(batterySamples)
+    self._gridPower = WindowStats(batterySamples)
     
     self._batteryReduceloadCount = 0
     self._batteryIncreaseloadCount = 0
-    self._batteryCount = 0
+    # last measurement of the site, None while the grid meter is not available
+    self._site = None
+    self._siteAvailable = True
     
     # last update
     self._lastUpdate = 0
+    # last status of the charger, None while it is not available
+    self._chargerData = None
+    self._chargerIdle = False
+    # change detection of the status
+    self._lastData = None
+    self._lastFingerprint = None
+    self._skippedTicks = 0
+    self._pollLatency = None
+    self._pollCount = 0
+    self._pollErrors = 0
+    # writes per charger parameter
+    self._setpointChanges = {}
     self._frame = 0
     
     # charging time in float
     self._chargingTime = 0.0
     
-    self._statusMessage = ""
+    # format string and arguments, only formatted by the sign of life
+    self._statusMessage = ("",)
+    
+    # binary log of the inputs and decisions of every update
+    self._recorder = None
+    self._lastNewCurrent = None
+    if self._settings.recorder.enabled:
+       recorder = self._settings.recorder
+       recorderFile = recorder.file
+       if len(self._settings.chargers) > 1:
+          recorderFile = "%s.%s" % (recorder.file, self._chargerName)
+       self._recorder = Recorder(recorderFile, recorder.maxFileSize, recorder.maxFiles, recorder.flushInterval)
+       logging.info("Recording to %s", recorderFile)
+    
+    # fetch /status off the GLib loop if configured, several chargers are always polled concurrently
+    self._poller = None
+    if self._settings.default.asyncPoll or executor is not None:
+       self._poller = AsyncStatusPoller(self._getGoeChargerData, self._processChargerData, self._settings.default.pollsInFlight, self._settings.default.pollStaleAfter, executor)
+
+    # with MQTT push the status arrives by itself and polling only acts as a watchdog
+    self._push = None
+    default = self._settings.default
+    intervals = (default.idleInterval, default.connectedInterval, default.chargingInterval, default.boostInterval)
+    if self._settings.mqtt.host:
+       topic = charger.mqttTopic
+       if not topic and data:
+          topic = "go-eCharger/%s" % (data['sse'])
+       try:
+          if not topic:
+             raise ValueError("no MQTT/Topic configured and serial unknown")
+          self._push = MqttPushListener(self._settings.mqtt.host, self._settings.mqtt.port, topic, self._onPushData, self._settings.mqtt.minInterval)
+          watchdogInterval = int(self._settings.mqtt.watchdogInterval * 1000)
+          intervals = (watchdogInterval,) * 4
+          logging.info("MQTT::Push ingestion from %s:%s %s, poll every %s s", self._settings.mqtt.host, self._settings.mqtt.port, topic, watchdogInterval / 1000)
+       except Exception as e:
+          logging.error("MQTT::Push ingestion not available, keep polling: %s", e)
 
-    # add _update function 'timer'
-    gobject.timeout_add(1000, self._update) # pause 250ms before the next request
+    # the charger is polled as often as its state needs, the site is measured at a fixed rate and the
+    # controllers run on their own periods on the last status and measurement
+    self._polls = PollScheduler(self._poll, *intervals, boostDuration=default.boostDuration)
+    self._polls.start()
+    self._tasks = [PeriodicTask('update', default.updateInterval, self._update),
+                   PeriodicTask('pv', default.pvInterval, self._controlPV)]
+    if self._primary:
+       self._tasks.append(PeriodicTask('battery', default.batteryInterval, self._controlBattery))
+       self._tasks.append(PeriodicTask('nightmode', default.nightModeInterval, self._controlNightMode))
+    for task in self._tasks:
+       task.start()
     
     # add _signOfLife 'timer' to get feedback in log every 5minutes
     gobject.timeout_add(self._getSignOfLifeInterval()*60*1000, self._signOfLife)
+    
+    # pick up edits of config.ini without restart, SIGHUP forces a reload
+    gobject.timeout_add(10*1000, self._checkConfig)
+    if self._primary and hasattr(gobject, 'unix_signal_add'):
+       gobject.unix_signal_add(gobject.PRIORITY_DEFAULT, signal.SIGHUP, self._reloadConfig)
+       # SIGUSR1 starts cProfile, the next one writes the profile next to the log-file
+       gobject.unix_signal_add(gobject.PRIORITY_DEFAULT, signal.SIGUSR1, self._toggleProfile)
+    
+    gobject.timeout_add(10*1000, self._publishStages)
  
-  def _getConfig(self):
-    config = configparser.ConfigParser(strict=False)
-    config.read("%s/config.ini" % (os.path.dirname(os.path.realpath(__file__))))
-    return config
- 
-  def _getLoggingLevel(self, config):
-    print(config['DEFAULT']['LOG_level'])
-    log_level_info = {'logging.DEBUG': logging.DEBUG, 
-                        'logging.INFO': logging.INFO,
-                        'logging.WARNING': logging.WARNING,
-                        'logging.ERROR': logging.ERROR,
-                        }
-    my_log_level_from_config = config['DEFAULT']['Log_Level']
-    my_log_level = log_level_info.get(my_log_level_from_config, logging.ERROR)
-    logging.getLogger().setLevel(my_log_level)
+  def _applySettings(self, settings):
+    charger = None
+    for candidate in settings.chargers:
+      if candidate.name == self._chargerName:
+        charger = candidate
+    if charger is None:
+      if not hasattr(self, '_charger'):
+        raise ValueError("Charger %s not found in config.ini" % (self._chargerName))
+      # a charger can not be removed or renamed at runtime
+      logging.error("Charger %s missing in config.ini, keep its previous settings", self._chargerName)
+      charger = self._charger
     
-  def _getSignOfLifeInterval(self):
-    config = self._getConfig()
-    value = config['DEFAULT']['SignOfLifeLog']
+    self._settings = settings
+    self._charger = charger
+    setLogLevels(settings.default)
+    
+    self._SetL1 = charger.phaseL1
+    self._SwitchL2L3 = charger.switchL1L2
+    if self._balancer is not None and self._primary:
+      self._balancer.setMainFuse(settings.balancer.mainFuse)
+    if self._scheduler is not None and self._primary:
+      self._scheduler.configure(settings.schedule, settings.nightMode)
     
-    if not value: 
-        value = 0
+    self._DisableDischargeAtPower = settings.load.disableDischargeAtPower
+    self._DisableExternalDischargeAtPower = settings.load.disableExternalDischargeAtPower
     
-    return int(value)
+    self._nM_StartHour = settings.nightMode.startHour
+    self._nM_EndHour = settings.nightMode.endHour
+    self._nM_MaxExternalSOC = settings.nightMode.maxExternalSOC
+    self._nM_MinExternalSOC = settings.nightMode.minExternalSOC
+    self._nM_MaxExternalCharge = settings.nightMode.maxExternalCharge
+    self._nM_GridSetPoint = settings.nightMode.gridSetPoint
+    self._nM_MaxDischarge = settings.nightMode.maxDischarge
   
+  def _checkConfig(self):
+    if self._config.reloadIfChanged():
+       logging.info("config.ini changed, settings reloaded")
+    # the config is shared, another charger may have reloaded it
+    if self._config.settings is not self._settings:
+       self._applySettings(self._config.settings)
+    return True
   
-  def _getGoeChargerStatusUrl(self):
-    config = self._getConfig()
-    accessType = config['DEFAULT']['AccessType']
-    
-    if accessType == 'OnPremise': 
-        URL = "http://%s/status" % (config['ONPREMISE']['Host'])
-    else:
-        raise ValueError("AccessType %s is not supported" % (config['DEFAULT']['AccessType']))
-    
-    return URL
+  def _reloadConfig(self):
+    logging.info("SIGHUP received, reload config.ini")
+    try:
+       self._config.load()
+    except Exception as e:
+       logging.error("Reload of config.ini failed, keep previous settings: %s", e)
+    self._checkConfig()
+    # keep the signal handler installed
+    return True
   
-  def _getGoeChargerMqttPayloadUrl(self, parameter, value):
-    config = self._getConfig()
-    accessType = config['DEFAULT']['AccessType']
-    
-    if accessType == 'OnPremise': 
-        URL = "http://%s/mqtt?payload=%s=%s" % (config['ONPREMISE']['Host'], parameter, value)
-    else:
-        raise ValueError("AccessType %s is not supported" % (config['DEFAULT']['AccessType']))
-    
-    return URL
+  def _getSignOfLifeInterval(self):
+    return self._settings.default.signOfLifeLog
   
   def _setGoeChargerValue(self, parameter, value):
-    print("_setGoeChargerValue ",parameter,"=",value)
-    URL = self._getGoeChargerMqttPayloadUrl(parameter, str(value))
-    request_data = requests.get(url = URL)
-    
-    # check for response
-    if not request_data:
-      raise ConnectionError("No response from go-eCharger - %s" % (URL))
-    
-    json_data = request_data.json()
-    
-    # check for Json
-    if not json_data:
-        raise ValueError("Converting response to JSON failed")
-    
-    if json_data[parameter] == str(value):
-      return True
-    else:
-      logging.warning("go-eCharger parameter %s not set to %s" % (parameter, str(value)))
-      return False
-    
+    logWallbox.debug("WALLBOX::Set %s = %s", parameter, value)
+    self._setpointChanges[parameter] = self._setpointChanges.get(parameter, 0) + 1
+    # accepted, sent in the background and confirmed by a later status
+    self._commands.put(parameter, value)
+    self._polls.boost()
+    return True
  
   def _getGoeChargerData(self):
-    URL = self._getGoeChargerStatusUrl()
     try:
-       request_data = requests.get(url = URL, timeout=5)
-    except Exception:
+       return self._source.getStatus()
+    except requests.exceptions.RequestException:
        return None
-    
-    # check for response
-    if not request_data:
-        raise ConnectionError("No response from go-eCharger - %s" % (URL))
-    
-    json_data = request_data.json()     
-    
-    # check for Json
-    if not json_data:
-        raise ValueError("Converting response to JSON failed")
-    
-    
-    return json_data
  
  
   def _signOfLife(self):
     logging.info("--- Start: sign of life ---")
-    logging.info("Last _update() call: %s" % (self._lastUpdate))
-    logging.info("Last '/Ac/Power': %s" % (self._dbusservice['/Ac/Power']))
+    logging.info("Last _update() call: %s", self._lastUpdate)
+    logging.info("Last '/Ac/Power': %s", self._dbusservice['/Ac/Power'])
     try:
-       logging.info("Last 'com.victronenergy.acsystem.VartaElement:/Ac/In/1/P': %s" % (self._powerBatteryExt.GetValue()))
+       logging.info("Last 'com.victronenergy.acsystem.VartaElement:/Ac/In/1/P': %s", self._dbusValues.get(SERVICE_VARTA, '/Ac/In/1/P'))
     except Exception:
        logging.info("Last 'com.victronenergy.acsystem.VartaElement:/Ac/In/1/P': No connection")
-    logging.info("Last '/Mode': %s" % (self._dbusservice['/Mode']))
-    logging.info("Last '/SetCurrent': %s" % (self._dbusservice['/SetCurrent']))
-    logging.info("Last 'lastCurrentAvg': %s" % (self._lastCurrentAvg))
-    logging.info("Last 'statusMessage': %s" % (self._statusMessage))
+    logging.info("Last '/Mode': %s", self._dbusservice['/Mode'])
+    logging.info("Last '/SetCurrent': %s", self._dbusservice['/SetCurrent'])
+    logging.info("Last 'lastCurrentAvg': %s", self._lastCurrentAvg)
+    logging.info("Grid power of the last %s updates: mean %s W ema %s W min %s W p90 %s W max %s W", self._gridPower.count, int(self._gridPower.mean), self._gridPower.ema, int(self._gridPower.min), int(self._gridPower.percentile(90)), int(self._gridPower.max))
+    logging.info("Last 'statusMessage': " + self._statusMessage[0], *self._statusMessage[1:])
+    logging.info("Last poll latency: %s ms", self._dbusservice['/Debug/PollLatency'])
+    logging.info("Idle updates skipped: %s unchanged responses: %s", self._skippedTicks, self._source.unchanged)
+    logging.info("D-Bus values published: %s signals: %s avoided signals: %s (within deadband: %s)", self._publisher.published, self._publisher.signals, self._publisher.avoided, self._publisher.filtered)
+    logging.info("D-Bus reads: %s polled: %s signals: %s writes: %s coalesced: %s rejected: %s", self._dbusValues.reads, self._dbusValues.polls, self._dbusValues.signals, self._dbusValues.writes, self._dbusValues.coalesced, self._dbusValues.rejected)
+    for service, path, age in self._dbusValues.ages():
+       logging.info("Age of %s:%s: %s s", service, path, None if age is None else int(age))
+    logging.info("HTTP requests: %s reused connections: %s reconnects: %s", self._http.requests, self._http.reused, self._http.reconnects)
+    logging.info("Health failures/trips/rejected - %s", ' '.join('%s: %s %s/%s/%s' % (name, CircuitBreaker.STATES[breaker.state], breaker.failures, breaker.trips, breaker.rejected)
+                 for name, breaker in [('Charger', self._chargerHealth)] + [(name, self._dbusValues.health(service)) for name, service in self.HEALTH_SERVICES]))
+    logging.info("Charger writes: %s coalesced: %s requests: %s confirmed: %s retries: %s failed: %s", self._commands.queued, self._commands.coalesced, self._commands.requests, self._commands.confirmed, self._commands.retries, self._commands.failed)
+    if self._recorder is not None:
+       logging.info("Recorded updates: %s rotations: %s", self._recorder.records, self._recorder.rotations)
+    if self._push is not None:
+       logging.info("MQTT messages: %s processed: %s last: %s", self._push.messages, self._push.deliveries, self._push.lastMessage)
+    if self._poller is not None:
+       logging.info("Async polls skipped: %s dropped: %s", self._poller.skipped, self._poller.dropped)
+    logging.info("Poll interval: %s ms reschedules: %s", self._polls.interval, self._polls.reschedules)
+    logging.info("Latency p50/p95/max ms - %s", self._stages.summary())
+    logging.info("Tasks runs/overruns/late - %s", ' '.join('%s: %s/%s/%s' % (task.name, task.runs, task.overruns, task.late) for task in self._tasks))
+    # the next period counts twice as much as everything before
+    self._stages.age()
+    if self._balancer is not None:
+       logging.info("Site surplus: %s W allocation: %s", self._balancer.surplus, self._balancer.allocation(self._chargerName))
     logging.info("--- End: sign of life ---")
     return True
   
+  def _publishStages(self):
+    def _ms(seconds):
+       return None if seconds is None else round(seconds * 1000, 1)
+    for stage in self.STAGES:
+       histogram = self._stages[stage]
+       path = '/Debug/Latency/%s/' % (stage.capitalize())
+       self._publisher[path + 'P50'] = _ms(histogram.percentile(50))
+       self._publisher[path + 'P95'] = _ms(histogram.percentile(95))
+       self._publisher[path + 'Max'] = _ms(histogram.max if histogram.count else None)
+    self._publisher.commit()
+    return True
+  
+  def metrics(self):
+    # collector of the MetricsExporter, runs on the GLib loop
+    charger = {'charger': self._chargerName or self._charger.guiName}
+    def _with(**labels):
+       return dict(charger, **labels)
+    data = self._chargerData
+    
+    samples = [
+      ('goecharger_polls_total', 'counter', 'Status polls and pushes processed', charger, self._pollCount),
+      ('goecharger_poll_errors_total', 'counter', 'Status polls without a status', charger, self._pollErrors),
+      ('goecharger_polls_skipped_total', 'counter', 'Status updates skipped because the idle charger did not change', charger, self._skippedTicks),
+      ('goecharger_poll_latency_seconds', 'gauge', 'Duration of the last status request', charger, self._pollLatency),
+      ('goecharger_poll_interval_seconds', 'gauge', 'Current poll interval', charger, self._polls.interval / 1000.0),
+      ('goecharger_http_requests_total', 'counter', 'HTTP requests to the charger', charger, self._http.requests),
+      ('goecharger_http_errors_total', 'counter', 'Failed HTTP requests to the charger', charger, self._chargerHealth.failures),
+      ('goecharger_http_rejected_total', 'counter', 'HTTP requests not sent while the charger was unavailable', charger, self._chargerHealth.rejected),
+      ('goecharger_charger_writes_total', 'counter', 'Write requests sent to the charger', charger, self._commands.requests),
+      ('goecharger_charger_write_failures_total', 'counter', 'Charger parameters given up after all retries', charger, self._commands.failed),
+      ('goecharger_pv_overload_count', 'gauge', 'Updates in a row with PV surplus', charger, self._powerOverload.count),
+      ('goecharger_pv_underload_count', 'gauge', 'Updates in a row with PV deficit', charger, self._powerUnderload.count),
+      ('goecharger_charging_time_seconds', 'gauge', 'Charging time of the current session', charger, self._chargingTime),
+      ('goecharger_power_watts', 'gauge', 'Charging power', charger, self._dbusservice['/Ac/Power']),
+      ('goecharger_set_current_amperes', 'gauge', 'Charging current set', charger, self._dbusservice['/SetCurrent']),
+      ('goecharger_status', 'gauge', 'Status of the charger, 0 disconnected, 1 connected, 2 charging', charger, self._dbusservice['/Status']),
+      ('goecharger_energy_kwh_total', 'counter', 'Energy charged over the lifetime of the charger', charger, float(data['eto']) / 10.0 if data is not None else None),
+    ]
+    for parameter, count in sorted(self._setpointChanges.items()):
+       samples.append(('goecharger_setpoint_changes_total', 'counter', 'Values set on the charger per parameter', _with(parameter=parameter), count))
+    samples.append(('goecharger_health', 'gauge', 'State of a dependency, 0 ok, 1 unavailable, 2 probing', _with(dependency='Charger'), self._chargerHealth.state))
+    for task in self._tasks:
+       samples.append(('goecharger_task_runs_total', 'counter', 'Runs of a periodic task', _with(task=task.name), task.runs))
+       samples.append(('goecharger_task_overruns_total', 'counter', 'Runs of a periodic task longer than its period', _with(task=task.name), task.overruns))
+    for stage in self.STAGES:
+       histogram = self._stages[stage]
+       for quantile in (50, 95):
+          samples.append(('goecharger_stage_latency_seconds', 'gauge', 'Latency of a stage of the update, recent updates weigh most',
+                          _with(stage=stage, quantile=quantile / 100.0), histogram.percentile(quantile)))
+    
+    # the batteries, the night mode and the shared D-Bus cache belong to the site
+    if self._primary:
+       dbusValues = self._dbusValues
+       samples.extend([
+         ('goecharger_nightmode', 'gauge', 'Night mode active', {}, int(self._nightMode)),
+         ('goecharger_dbus_reads_total', 'counter', 'Values read from other D-Bus services', {}, dbusValues.reads),
+         ('goecharger_dbus_polls_total', 'counter', 'GetValue calls to other D-Bus services', {}, dbusValues.polls),
+         ('goecharger_dbus_signals_total', 'counter', 'Change signals received from other D-Bus services', {}, dbusValues.signals),
+         ('goecharger_dbus_writes_total', 'counter', 'SetValue calls to other D-Bus services', {}, dbusValues.writes),
+         ('goecharger_dbus_rejected_total', 'counter', 'Writes dropped while the D-Bus service was unavailable', {}, dbusValues.rejected),
+       ])
+       for name, service in self.HEALTH_SERVICES:
+          samples.append(('goecharger_health', 'gauge', 'State of a dependency, 0 ok, 1 unavailable, 2 probing', {'dependency': name}, dbusValues.health(service).state))
+    return samples
+  
+  def _toggleProfile(self):
+    if self._profile is None:
+       logging.info("Profiling started, send SIGUSR1 again to write the profile")
+       self._profile = cProfile.Profile()
+       self._profile.enable()
+       return True
+    
+    self._profile.disable()
+    path = os.path.join(os.path.dirname(self._settings.default.logFile), 'goecharger-%s.prof' % (os.getpid()))
+    self._profile.dump_stats(path)
+    output = io.StringIO()
+    pstats.Stats(self._profile, stream=output).sort_stats('cumulative').print_stats(25)
+    logging.info("Profile written to %s (load with python -m pstats)\n%s", path, output.getvalue())
+    self._profile = None
+    return True
+  
   def _evCharger2GoeMode(self, mode):
     if mode==0:
         return 0
@@ -305,12 +2453,24 @@ class DbusGoeChargerService:
         return 2
     else:
         return 1
+  
+  def _goeCar2EvCharger(self, car):
+    # value 'car' 1: charging station ready, no vehicle 2: vehicle loads 3: Waiting for vehicle 4: Charge finished, vehicle still connected
+    if car==2:
+        return 2
+    elif car==3:
+        return 6
+    elif car==4:
+        return 3
+    else:
+        return 0
         
   def reset(self):
-     logging.info("BATT::Reset maxCharge= %s W maxDischarge= %s W",self._powerBatteryMaxCharge_reset,self._powerBatteryMaxDischarge_reset)
-     self._powerBatteryMaxCharge.SetValue(self._powerBatteryMaxCharge_reset)
-     self._powerBatteryMaxDischarge.SetValue(self._powerBatteryMaxDischarge_reset)
-     logging.info("BATT::Ext::Reset not necessary because timeout")
+     logBattery.info("BATT::Reset maxCharge= %s W maxDischarge= %s W",self._powerBatteryMaxCharge_reset,self._powerBatteryMaxDischarge_reset)
+     # at exit, no main loop left to send asynchronous calls
+     self._dbusValues.set(SERVICE_SETTINGS, '/Settings/CGwacs/MaxChargePower', self._powerBatteryMaxCharge_reset, block=True)
+     self._dbusValues.set(SERVICE_SETTINGS, '/Settings/CGwacs/MaxDischargePower', self._powerBatteryMaxDischarge_reset, block=True)
+     logBattery.info("BATT::Ext::Reset not necessary because timeout")
   
   def _batterySetExternalUnload(self, power, maxPower):
     if power>0:
@@ -318,10 +2478,10 @@ class DbusGoeChargerService:
     if power<self._powerBatteryMaxDischargeExt_reset:
        power = self._powerBatteryMaxDischargeExt_reset
     
-    print("CALL::batterySetExternalUnload power = ",power," maxPower = ",maxPower)    
+    logBattery.debug("BATT::Ext::SetUnload power = %s W maxPower = %s W", power, maxPower)
     if power!=maxPower:
        self._powerBatteryMaxDischargeExt_last = power
-       self._powerBatteryMaxDischargeExt.SetValue(power)
+       self._dbusValues.set(SERVICE_VARTA, '/Ac/Out/CurrentLimit', power)
   
   def _batterySetExternalLoad(self, power, maxPower):
     if power<0:
@@ -333,7 +2493,7 @@ class DbusGoeChargerService:
     if power!=maxPower:
         #print("_batterySetLoad SetValue->",power)
         self._powerBatteryMaxChargeExt_last = power
-        self._powerBatteryMaxChargeExt.SetValue(power)
+        self._dbusValues.set(SERVICE_VARTA, '/Ac/In/1/CurrentLimit', power)
   
   def _batterySetUnload(self, power, maxPower):
     if power<0:
@@ -343,7 +2503,7 @@ class DbusGoeChargerService:
        
     if power!=maxPower:
        self._powerBatteryMaxDischarge_last = power
-       self._powerBatteryMaxDischarge.SetValue(power)
+       self._dbusValues.set(SERVICE_SETTINGS, '/Settings/CGwacs/MaxDischargePower', power)
   
   def _batterySetLoad(self, power, maxPower):
     if power<0:
@@ -355,33 +2515,33 @@ class DbusGoeChargerService:
     if power!=maxPower:
         #print("_batterySetLoad SetValue->",power)
         self._powerBatteryMaxCharge_last = power
-        self._powerBatteryMaxCharge.SetValue(power)
+        self._dbusValues.set(SERVICE_SETTINGS, '/Settings/CGwacs/MaxChargePower', power)
         
   def _gridSetGridSetPoint(self, value, last):
     if value!=last:
-        self._socBatteryExt_last = value
-        self._socBatteryExt.SetValue(value)
+        self._gridGridSetPoint_last = value
+        self._dbusValues.set(SERVICE_SETTINGS, '/Settings/CGwacs/AcPowerSetPoint', value)
         
   def _gridResetGridSetPoint(self, value):
-    if value!=self._socBatteryExt_reset:
-        self._socBatteryExt_last = self._socBatteryExt_reset
-        self._socBatteryExt.SetValue(self._socBatteryExt_reset)
+    if value!=self._gridGridSetPoint_reset:
+        self._gridGridSetPoint_last = self._gridGridSetPoint_reset
+        self._dbusValues.set(SERVICE_SETTINGS, '/Settings/CGwacs/AcPowerSetPoint', self._gridGridSetPoint_reset)
         
   def _pvSetLoad(self, current, currentMax, enableRestart = False):
     #print("_pvSetLoad(",current," A, ",currentMax," A)")
     if current==0:
        if self._dbusservice['/StartStop']==1:
-          logging.info("Wallbox::Stop Loading")   
+          logWallbox.info("Wallbox::Stop Loading")   
           self._dbusservice['/StartStop'] = 0
           self._setGoeChargerValue('alw', 0)
           if enableRestart:
-             logging.info("Wallbox::Enable Restart")  
+             logWallbox.info("Wallbox::Enable Restart")  
              self._enableRestart = True
        #else:
        #   logging.info("Wallbox::Already Stopped")
           
        if currentMax>0 and self._dbusservice['/SetCurrent']!=currentMax:
-          logging.info("Wallbox::Reset current to %s A" % (currentMax))
+          logWallbox.info("Wallbox::Reset current to %s A", currentMax)
           self._dbusservice['/SetCurrent'] = currentMax   
           self._setGoeChargerValue('amp', currentMax)
     else:
@@ -389,47 +2549,57 @@ class DbusGoeChargerService:
           current = currentMax
           
        if self._dbusservice['/SetCurrent']!=current:
-          logging.info("Wallbox::Set current to %s A" % (current))
+          logWallbox.info("Wallbox::Set current to %s A", current)
           self._dbusservice['/SetCurrent'] = current   
           self._setGoeChargerValue('amp', current)
        if self._dbusservice['/StartStop']==0:
-          logging.info("Wallbox::Start Loading") 
-          self._finishLoadCounter = 30
+          logWallbox.info("Wallbox::Start Loading") 
+          self._finishLoadCounter = self._finishLoadCounterLimit
           self._dbusservice['/StartStop'] = 1  
           self._setGoeChargerValue('alw', 1)
           if enableRestart: # -> change with status
              self._enableRestart = False
   
-  def _getNumberOfPhases(self, powerL1, powerL2, powerL3):
-        count = 0;
-        
-        if powerL1>0: 
-            count = count+1
-        if powerL2>0: 
-            count = count+1
-        if powerL3>0: 
-            count = count+1
-        # BUG
-        if count==3:
-            factor = powerL3/((powerL1 + powerL2)/2.0);
-            count = 2 + factor;
-        
-        return count
-	
-  def getPowerWallbox(self, current): 
-    return current*230*self._lastNumberOfPhases
+  def getPowerWallbox(self, current, phases=None): 
+    return self._phaseModel.predict(current, phases or self._lastNumberOfPhases)
 	
 	
   def getPowerWallboxUp(self, current): 
-    return -1.0*(self.getPowerWallbox(current)+200)
+    return -1.0*(self.getPowerWallbox(current)+self._phaseModel.margin(self._lastNumberOfPhases))
 
   def getPowerWallboxDown(self, current): 
-    return -1.0*(self.getPowerWallbox(current)-200)
+    return -1.0*(self.getPowerWallbox(current)-self._phaseModel.margin(self._lastNumberOfPhases))
+  
+  def _solveCurrentUp(self, power, current, maxCurrent, phases):
+    # smallest current whose power covers the surplus less the margin, where stepping up 1 A at a time ended
+    target = int(math.ceil((-power - self._phaseModel.margin(phases)) / self._phaseModel.wattsPerAmp(phases) - 1e-9))
+    return max(current, min(maxCurrent, target))
+  
+  def _solveCurrentDown(self, power, current, phases):
+    # largest current whose power stays below the surplus plus the margin, where stepping down 1 A at a time ended
+    target = int(math.floor((self._phaseModel.margin(phases) - power) / self._phaseModel.wattsPerAmp(phases) + 1e-9))
+    target = max(0, min(current, target))
+    if target < self.MIN_CURRENT:
+      target = 0
+    return target
+  
+  def _switchPhases(self, phases):
+    if not self._charger.phaseSwitching or self._phaseMode == phases:
+      return False
+    logWallbox.info("Wallbox::Switch to %s phase(s)", phases)
+    # psm 1: force 1 phase, 2: force 3 phases
+    if not self._setGoeChargerValue('psm', 1 if phases == 1 else 2):
+      return False
+    self._phaseMode = phases
+    self._phaseSwitched = time.time()
+    self._lastNumberOfPhases = phases
+    return True
 
-  def _updatePVsurplusCharging(self, powerGrid, powerWallbox, powerBattery, powerBatteryExt, current, maxCurrent, msg):
+  def _updatePVsurplusCharging(self, powerGrid, powerWallbox, powerBattery, powerBatteryExt, current, maxCurrent):
     #print("_updatePVsurplusCharging")
     border = 30
-    debug = True
+    # the arguments of the debug lines cost more than the control step itself
+    debug = logWallbox.isEnabledFor(logging.DEBUG)
     power = powerGrid - powerWallbox - (0,powerBattery - self._minPowerLoadBatteryDuringCharging)[powerBattery>0] - (0, powerBatteryExt - self._minPowerLoadBatteryDuringChargingExt)[powerBatteryExt>0]
 		
     if powerBattery < -self._maxPowerUnloadBatteryDuringCharging:
@@ -437,66 +2607,60 @@ class DbusGoeChargerService:
     if powerBatteryExt < -self._maxPowerUnloadBatteryDuringChargingExt:
     	power = power + (self._maxPowerUnloadBatteryDuringChargingExt - powerBatteryExt)
 
-    logging.debug("WALLBOX::updatePVsurplus _pvCount= %s - %s power = %s W (up %s W, down %s W) wallbox = %s W battery = %s W (%s W) batteryExt = %s W (%s W)",self._pvOverloadCount,self._pvUnderloadCount,power,self.getPowerWallboxUp(current),self.getPowerWallboxDown(current),powerWallbox, powerBattery,self._maxPowerUnloadBatteryDuringCharging,powerBatteryExt,self._maxPowerUnloadBatteryDuringChargingExt)
+    if debug:
+       logWallbox.debug("WALLBOX::updatePVsurplus _pvCount= %s - %s power = %s W (up %s W, down %s W) wallbox = %s W battery = %s W (%s W) batteryExt = %s W (%s W)",self._powerOverload.count,self._powerUnderload.count,power,self.getPowerWallboxUp(current),self.getPowerWallboxDown(current),powerWallbox, powerBattery,self._maxPowerUnloadBatteryDuringCharging,powerBatteryExt,self._maxPowerUnloadBatteryDuringChargingExt)
 
-    logging.debug("WALLBOX::updatePVsurplus _currentCount = %s wallboxAvg = %s W",self._pvCurrentCount,self._powerWallboxAvg)
+    self._powerWallbox.add(powerWallbox)
+    logWallbox.debug("WALLBOX::updatePVsurplus wallboxAvg = %s W",self._powerWallbox.mean)
     
-    #newCurrent = current
-    
-    if self._pvCurrentCount>=border:
-        self._pvCurrentCount = 0;
-        #if self._powerWallboxAvg==0:
-        #    current = 6;
-        #if self._powerWallboxAvg>0 and self._powerWallboxAvg<500 and current>0:
-            #Stop Load and wait for disconnect
-        #    self._waitForDisconnect = True
-        #    return 0
-    else:
-        self._powerWallboxAvg = (self._powerWallboxAvg * self._pvCurrentCount +powerWallbox)/(self._pvCurrentCount +1)
-        self._pvCurrentCount = self._pvCurrentCount +1
-        
     newCurrent = current
     
-    msg = "power ="+str(power)+" powerUp="+str(self.getPowerWallboxUp(newCurrent))+" powerWallbox="+str(powerWallbox)+" avg="+str(self._powerWallboxAvg)
     if self.getPowerWallboxUp(newCurrent)> power:
-    	self._powerOverloadAvg = (self._powerOverloadAvg*self._pvOverloadCount + power)/(self._pvOverloadCount + 1);
-    	self._pvUnderloadCount = 0
-    	self._pvOverloadCount = self._pvOverloadCount + 1
+    	self._powerUnderload.clear()
+    	self._powerOverload.add(power)
     # elif self.getPowerWallboxDown(self._lastCurrentAvg)< power:
     elif self.getPowerWallboxDown(newCurrent)< power:
-        self._powerUnderloadAvg = (self._powerUnderloadAvg*self._pvUnderloadCount + power)/(self._pvUnderloadCount + 1);
-        self._pvOverloadCount = 0
-        if self._powerWallboxAvg>0:
-            self._pvUnderloadCount = self._pvUnderloadCount + 1
+        self._powerOverload.clear()
+        if self._powerWallbox.mean>0:
+            self._powerUnderload.add(power)
         else:
-            self._pvUnderloadCount = 0
+            self._powerUnderload.clear()
     else:
-    	self._pvUnderloadCount = 0
-    	self._pvOverloadCount = 0
+    	self._powerUnderload.clear()
+    	self._powerOverload.clear()
 
         
-    if self._pvOverloadCount>=border:
-    	self._pvOverloadCount = 0		
-    	while newCurrent<maxCurrent and self.getPowerWallboxUp(newCurrent)> self._powerOverloadAvg:			
-    		newCurrent = newCurrent+1
-
-    	if debug: 
-    		logging.info("UP to %s A => %s W > %s W",current, self.getPowerWallboxUp(newCurrent),power)
+    if self._powerOverload.count>=border:
+    	powerOverload = self._powerOverload.mean
+    	self._powerOverload.clear()
+    	# back to three phases only well above their minimum, the margin is the switching hysteresis
+    	if self._lastNumberOfPhases==1 and -powerOverload >= self.getPowerWallbox(self.MIN_CURRENT, 3) + self.PHASE_SWITCH_HYSTERESIS:
+    		if self._switchPhases(3):
+    			newCurrent = self.MIN_CURRENT
+    	newCurrent = self._solveCurrentUp(powerOverload, newCurrent, maxCurrent, self._lastNumberOfPhases)
 
-    if self._pvUnderloadCount>=border:
-    	logging.info("UnderloadCoun Reach Border -> newCurrent = %s A powerUnderload = %s W",newCurrent,self._powerUnderloadAvg);
-    	self._pvUnderloadCount = 0	
-    	while newCurrent>0 and self.getPowerWallboxDown(newCurrent)< self._powerUnderloadAvg:
-    		newCurrent = newCurrent-1
+    	logWallbox.info("WALLBOX::UP to %s A => %s W > %s W",newCurrent, self.getPowerWallboxUp(newCurrent),power)
 
-    	if newCurrent<6:
-           newCurrent = 0
+    # a deficit of more than one step even at its smallest (cloud) is followed after a third of the border
+    deepUnderload = self._powerUnderload.count>=border//3 and newCurrent>0 and self.getPowerWallboxDown(newCurrent-1)< self._powerUnderload.min
+    if self._powerUnderload.count>=border or deepUnderload:
+    	powerUnderload = self._powerUnderload.mean
+    	logWallbox.info("WALLBOX::Underload count reached border -> current = %s A powerUnderload = %s W",newCurrent,powerUnderload);
+    	self._powerUnderload.clear()
+    	phases = self._lastNumberOfPhases
+    	newCurrent = self._solveCurrentDown(powerUnderload, newCurrent, phases)
+    	# below the three phase minimum one phase may still carry the surplus
+    	if newCurrent==0 and phases==3 and self._charger.phaseSwitching:
+    		currentOnePhase = self._solveCurrentDown(powerUnderload, maxCurrent, 1)
+    		if currentOnePhase>0 and self._switchPhases(1):
+    			newCurrent = currentOnePhase
 
-    	if debug: 
-    		logging.info("Down to %s A => %s W < %s W",newCurrent,self.getPowerWallboxDown(current),power)
+    	logWallbox.info("WALLBOX::Down to %s A => %s W < %s W",newCurrent,self.getPowerWallboxDown(current),power)
 
     if debug: 
-    	print("=> ",current," A -> ",newCurrent," A underloadCount =",self._pvUnderloadCount," overloadCount =",self._pvOverloadCount, "Power to turnUp/Down = ",self.getPowerWallboxUp(newCurrent),"/",self.getPowerWallboxDown(newCurrent)," power =",power," = grid =",powerGrid," - wallbox =",powerWallbox," - battery = ",powerBattery, " - batteryExt = ",powerBatteryExt)
+    	logWallbox.debug("WALLBOX::%s A -> %s A underloadCount = %s overloadCount = %s Power to turnUp/Down = %s/%s W power = %s W = grid %s W - wallbox %s W - battery %s W - batteryExt %s W",
+    	                 current, newCurrent, self._powerUnderload.count, self._powerOverload.count, self.getPowerWallboxUp(newCurrent), self.getPowerWallboxDown(newCurrent),
+    	                 power, powerGrid, powerWallbox, powerBattery, powerBatteryExt)
 
     #if newCurrent!=current:
     #	self._pvSetLoad(newCurrent, maxCurrent)
@@ -504,94 +2668,114 @@ class DbusGoeChargerService:
     return newCurrent
 
   def _updateBattery(self, gridPower, gridGridSetPoint, powerBattery, powerBatteryExt, powerBatteryMaxCharge, powerBatteryMaxDischarge, powerBatteryMaxChargeExt, powerBatteryMaxDischargeExt, socBattery, socBatteryExt, socBatteryLimit):
-    border = 15
     borderZeroBattery = 100
     #debug = False
     
-    logging.debug("BATT::Update _batterCount= %s BatteryAvg = %s W BatteryExtAvg = %s W Battery = %s W BatteryExt = %s W",self._batteryCount,int(self._powerBatteryAvg),int(self._powerBatteryExtAvg), int(powerBattery),int(powerBatteryExt));
-       
+    # the windows are filled by every measurement, this runs once per battery period
+    powerBatteryAvg = self._powerBattery.mean
+    powerBatteryExtAvg = self._powerBatteryExt.mean
+    # the grid EMA weighs the latest samples most and follows a cloud within a few ticks
+    gridPowerAvg = self._gridPower.ema
     
-    if self._batteryCount>=border:
-        self._batteryCount = 0
-        #print("_DisableDischargeAtPower = ",self._DisableDischargeAtPower," ",self._DisableExternalDischargeAtPower);
-        if self._DisableDischargeAtPower is not None:
-            print("Battery::DisableDischargeAtPower = ",self._DisableDischargeAtPower, self._gridPowerAvg)
-            if self._gridPowerAvg > self._DisableDischargeAtPower:
-               #Reduce UnLoad to Zero
-               self._batterySetUnload(0, powerBatteryMaxDischarge)
-            else:
-               self._batterySetUnload(self._powerBatteryMaxDischarge_reset, powerBatteryMaxDischarge)
-        if self._DisableExternalDischargeAtPower is not None:
-            print("Battery::DisableExternalDischargeAtPower = ",self._DisableExternalDischargeAtPower, self._gridPowerAvg)
-            if self._gridPowerAvg > self._DisableExternalDischargeAtPower:
-               self._batterySetExternalUnload(0, powerBatteryMaxDischargeExt)
-            else:
-               self._batterySetExternalUnload(self._powerBatteryMaxDischargeExt_reset, powerBatteryMaxDischargeExt)
-        
-        now = datetime.now(pytz.timezone("Europe/Berlin"))    
-        if self._nightMode == False:
-           print("NightMode::Activate Zeit ",now.hour," Start ",self._nM_StartHour," Ende ",self._nM_EndHour," ExtSOC ",socBatteryExt," <= ",self._nM_MaxExternalSOC," >= ",self._nM_MinExternalSOC)
-           if (now.hour >= self._nM_StartHour and now.hour < self._nM_EndHour) or (self._nM_StartHour > self._nM_EndHour and (now.hour >= self._nM_StartHour or now.hour < self._nM_EndHour)) and socBatteryExt<=self._nM_MaxExternalSOC and socBatteryExt>=self._nM_MinExternalSOC:
-              hourGap = 0
-              if now.hour > self._nM_EndHour:
-                 hourGap = (24 - now.hour) + self._nM_EndHour
-              else:
-                 hourGap = self._nM_EndHour - now.hour
-                 
-              print("NightMode::Check Discharge Time SOC ",socBattery," Limit ",socBatteryLimit," = ",(socBattery - socBatteryLimit)/5,"h current Gap = ",hourGap,"h")
-              if (socBattery - socBatteryLimit)/5 >= hourGap:
-                 self._nightMode = True
+    logBattery.debug("BATT::Update BatteryAvg = %s W BatteryExtAvg = %s W Battery = %s W BatteryExt = %s W",int(powerBatteryAvg),int(powerBatteryExtAvg), int(powerBattery),int(powerBatteryExt));
+    
+    #print("_DisableDischargeAtPower = ",self._DisableDischargeAtPower," ",self._DisableExternalDischargeAtPower);
+    if self._DisableDischargeAtPower is not None:
+        logBattery.debug("BATT::DisableDischargeAtPower = %s W gridAvg = %s W", self._DisableDischargeAtPower, gridPowerAvg)
+        if gridPowerAvg > self._DisableDischargeAtPower:
+           #Reduce UnLoad to Zero
+           self._batterySetUnload(0, powerBatteryMaxDischarge)
         else:
-           print("NightMode::Deactivate Zeit ",now.hour," Start ",self._nM_StartHour," Ende SOC ",socBattery," <= ",socBatteryLimit)
-           if (now.hour < self._nM_StartHour and now.hour >= self._nM_EndHour) or socBattery <= socBatteryLimit:
-              self._nightMode = False
-              self._batterySetExternalLoad(self._powerBatteryMaxChargeExt_reset, powerBatteryMaxChargeExt)
-              self._batterySetUnload(self._powerBatteryMaxCharge_reset, powerBatteryMaxDischarge)
-              self._gridResetGridSetPoint(gridGridSetPoint)
-        
-        if self._nightMode:
-            self._batterySetExternalLoad(self._nM_MaxExternalCharge, powerBatteryMaxChargeExt)
-            self._batterySetUnload(self._nM_MaxDischarge, powerBatteryMaxDischarge)
-            self._gridSetGridSetPoint(self._nM_GridSetPoint, gridGridSetPoint)
-        else:        
-            if self._powerBatteryAvg > borderZeroBattery and self._powerBatteryExtAvg<self._maxPowerUnloadBatteryExt:
-                #Reduce Load
-                value = round((self._powerBatteryAvg + (self._powerBatteryExtAvg))/100+0.5,0)*100
-                logging.info("BATT::[batteryAvg=%s W batteryExtAvg=%s W]\tReduce max. charge rate to %s W",int(self._powerBatteryAvg), int(self._powerBatteryExtAvg),(value))
-                self._batterySetLoad(value, powerBatteryMaxCharge)
-            elif self._powerBatteryExtAvg>=0 and powerBatteryMaxCharge<self._powerBatteryMaxCharge_reset:
-                #Reset Load when Ext Battery Charging
-                #if powerBatteryExt > 1000:
-                logging.info("BATT::[batteryAvg=%s W batteryExtAvg=%s W]\tIncrease max. charge rate to max by %s W",int(self._powerBatteryAvg), int(self._powerBatteryExtAvg),(self._powerBatteryMaxCharge_reset))
-                self._batterySetLoad(self._powerBatteryMaxCharge_reset, powerBatteryMaxCharge)
-                #else
-                #value = powerBattery-(gridPower+100)
-                #value = int(math.ceil(value / 100.0)) * 100
-                #logging.info("Increase max. charge rate to %s W" % (value))
-                #self._batterySetLoad(value, powerBatteryMaxCharge)
-            else:
-                logging.info("BATT::[batteryAvg=%s W batteryExtAvg=%s W]\tNo Action",int(self._powerBatteryAvg), int(self._powerBatteryExtAvg))
+           self._batterySetUnload(self._powerBatteryMaxDischarge_reset, powerBatteryMaxDischarge)
+    if self._DisableExternalDischargeAtPower is not None:
+        logBattery.debug("BATT::DisableExternalDischargeAtPower = %s W gridAvg = %s W", self._DisableExternalDischargeAtPower, gridPowerAvg)
+        if gridPowerAvg > self._DisableExternalDischargeAtPower:
+           self._batterySetExternalUnload(0, powerBatteryMaxDischargeExt)
+        else:
+           self._batterySetExternalUnload(self._powerBatteryMaxDischargeExt_reset, powerBatteryMaxDischargeExt)
+    
+    # entering and leaving the night mode is decided by _updateNightMode
+    slot = self._scheduler.lookup() if self._scheduler is not None else None
+    if self._nightMode and slot is not None and slot.nightMode and (slot.maxChargeExt <= self._nM_MaxExternalCharge or socBatteryExt < self._nM_MaxExternalSOC):
+        self._batterySetExternalLoad(slot.maxChargeExt, powerBatteryMaxChargeExt)
+        self._batterySetUnload(slot.maxDischarge, powerBatteryMaxDischarge)
+        self._gridSetGridSetPoint(slot.gridSetPoint, gridGridSetPoint)
+    elif self._nightMode:
+        # without a plan, in a PV slot or with the Varta charged to MaxExternalSOC
+        self._batterySetExternalLoad(self._nM_MaxExternalCharge, powerBatteryMaxChargeExt)
+        self._batterySetUnload(self._nM_MaxDischarge, powerBatteryMaxDischarge)
+        self._gridSetGridSetPoint(self._nM_GridSetPoint, gridGridSetPoint)
+    else:        
+        if powerBatteryAvg > borderZeroBattery and powerBatteryExtAvg<self._maxPowerUnloadBatteryExt:
+            #Reduce Load
+            value = round((powerBatteryAvg + (powerBatteryExtAvg))/100+0.5,0)*100
+            logBattery.info("BATT::[batteryAvg=%s W batteryExtAvg=%s W]\tReduce max. charge rate to %s W",int(powerBatteryAvg), int(powerBatteryExtAvg),(value))
+            self._batterySetLoad(value, powerBatteryMaxCharge)
+        elif powerBatteryExtAvg>=0 and powerBatteryMaxCharge<self._powerBatteryMaxCharge_reset:
+            #Reset Load when Ext Battery Charging
+            #if powerBatteryExt > 1000:
+            logBattery.info("BATT::[batteryAvg=%s W batteryExtAvg=%s W]\tIncrease max. charge rate to max by %s W",int(powerBatteryAvg), int(powerBatteryExtAvg),(self._powerBatteryMaxCharge_reset))
+            self._batterySetLoad(self._powerBatteryMaxCharge_reset, powerBatteryMaxCharge)
+            #else
+            #value = powerBattery-(gridPower+100)
+            #value = int(math.ceil(value / 100.0)) * 100
+            #logging.info("Increase max. charge rate to %s W" % (value))
+            #self._batterySetLoad(value, powerBatteryMaxCharge)
+        else:
+            logBattery.info("BATT::[batteryAvg=%s W batteryExtAvg=%s W]\tNo Action",int(powerBatteryAvg), int(powerBatteryExtAvg))
+
+  def _updateNightMode(self, gridGridSetPoint, powerBatteryMaxDischarge, powerBatteryMaxChargeExt, socBattery, socBatteryExt, socBatteryLimit):
+    # with a forecast the plan decides, the hour window of NIGHTMODE is the fallback without one
+    slot = self._scheduler.lookup() if self._scheduler is not None else None
+    if slot is not None:
+       if self._nightMode == False:
+          if slot.nightMode and slot.hoursToPv is not None and socBatteryExt<=self._nM_MaxExternalSOC and socBatteryExt>=self._nM_MinExternalSOC:
+             logNightMode.debug("NightMode::Check Discharge Time SOC %s Limit %s = %s h until PV %s h", socBattery, socBatteryLimit, (socBattery - socBatteryLimit)/self._settings.schedule.socPerHour, slot.hoursToPv)
+             if (socBattery - socBatteryLimit)/self._settings.schedule.socPerHour >= slot.hoursToPv:
+                self._nightMode = True
+       elif not slot.nightMode or socBattery <= socBatteryLimit:
+          self._leaveNightMode(powerBatteryMaxChargeExt, powerBatteryMaxDischarge, gridGridSetPoint)
     else:
-        self._powerBatteryAvg = (self._powerBatteryAvg * self._batteryCount +powerBattery)/(self._batteryCount +1)
-        self._powerBatteryExtAvg = (self._powerBatteryExtAvg * self._batteryCount +powerBatteryExt)/(self._batteryCount +1)
-        self._gridPowerAvg = (self._gridPowerAvg * self._batteryCount +gridPower)/(self._batteryCount +1)
-        self._batteryCount = self._batteryCount +1
+       now = datetime.now(pytz.timezone("Europe/Berlin"))    
+       if self._nightMode == False:
+          logNightMode.debug("NightMode::Activate Zeit %s Start %s Ende %s ExtSOC %s <= %s >= %s", now.hour, self._nM_StartHour, self._nM_EndHour, socBatteryExt, self._nM_MaxExternalSOC, self._nM_MinExternalSOC)
+          if (now.hour >= self._nM_StartHour and now.hour < self._nM_EndHour) or (self._nM_StartHour > self._nM_EndHour and (now.hour >= self._nM_StartHour or now.hour < self._nM_EndHour)) and socBatteryExt<=self._nM_MaxExternalSOC and socBatteryExt>=self._nM_MinExternalSOC:
+             hourGap = 0
+             if now.hour > self._nM_EndHour:
+                hourGap = (24 - now.hour) + self._nM_EndHour
+             else:
+                hourGap = self._nM_EndHour - now.hour
+             
+             logNightMode.debug("NightMode::Check Discharge Time SOC %s Limit %s = %s h current Gap = %s h", socBattery, socBatteryLimit, (socBattery - socBatteryLimit)/5, hourGap)
+             if (socBattery - socBatteryLimit)/5 >= hourGap:
+                self._nightMode = True
+       else:
+          logNightMode.debug("NightMode::Deactivate Zeit %s Start %s Ende SOC %s <= %s", now.hour, self._nM_StartHour, socBattery, socBatteryLimit)
+          if (now.hour < self._nM_StartHour and now.hour >= self._nM_EndHour) or socBattery <= socBatteryLimit:
+             self._leaveNightMode(powerBatteryMaxChargeExt, powerBatteryMaxDischarge, gridGridSetPoint)
+
+  def _leaveNightMode(self, powerBatteryMaxChargeExt, powerBatteryMaxDischarge, gridGridSetPoint):
+    self._nightMode = False
+    self._batterySetExternalLoad(self._powerBatteryMaxChargeExt_reset, powerBatteryMaxChargeExt)
+    self._batterySetUnload(self._powerBatteryMaxDischarge_reset, powerBatteryMaxDischarge)
+    self._gridResetGridSetPoint(gridGridSetPoint)
 
   def _updatePV(self, status, mode, powerGrid, powerWallbox, powerBattery, powerBatteryExt, current, maxCurrent): 
   	border = 60
   	
-  	logging.debug("WALLBOX::Update Status = %s Mode = %s External-StartStop = %s Current = %s A",status,mode,self._dbusservice['/ExternalStartStop'],self._dbusservice['/ExternalSetCurrent'])
+  	if logWallbox.isEnabledFor(logging.DEBUG):
+  		logWallbox.debug("WALLBOX::Update Status = %s Mode = %s External-StartStop = %s Current = %s A",status,mode,self._dbusservice['/ExternalStartStop'],self._dbusservice['/ExternalSetCurrent'])
 	
   	if self._finishLoadCounter>0:
   		self._finishLoadCounter = self._finishLoadCounter - 1
        
 	# Car is connected
   	if status==3 and (self._enableRestart==False and self._finishLoadCounter==0) and self._dbusservice['/ExternalStartStop']==0: #Charging finished
-  		self._statusMessage = "[Status=3] Charging finished [enableRestart="+str(self._enableRestart)+" counter="+str(self._restartCounter/self._restartCounterLimit*100)+"%]";
+  		self._statusMessage = ("[Status=3] Charging finished [enableRestart=%s counter=%s%%]", self._enableRestart, self._restartCounter/self._restartCounterLimit*100)
     
-  		self._pvUnderloadCount = 0
-  		self._pvOverloadCount = 0
-  		logging.info("WALLBOX::Auto finished")
+  		self._powerUnderload.clear()
+  		self._powerOverload.clear()
+  		logWallbox.info("WALLBOX::Auto finished")
   		if self._dbusservice['/ExternalStartStop']==0: #Externes Laden: Deaktiviert -> Reset Current to 16A 
   			self._pvSetLoad(0, maxCurrent)
   		#elif self._dbusservice['/ExternalSetCurrent']==0:					
@@ -601,48 +2785,57 @@ class DbusGoeChargerService:
   		#   self._enableRestart=False
            
   		if mode==0:
-  			self._statusMessage = "[Status = "+str(status)+"] Mode=0";
+  			self._statusMessage = ("[Status = %s] Mode=0", status)
   			self._enableRestart=True
-  			logging.debug("WALLBOX::Manual Mode")
+  			logWallbox.debug("WALLBOX::Manual Mode")
   		elif mode==1:
-  			logging.debug("WALLBOX::Auto Mode")
+  			logWallbox.debug("WALLBOX::Auto Mode")
   			
   			#if status!=3:
   			#   self._enableRestart=False
            
-  			self._statusMessage = "[Status = "+str(status)+"] Mode=1";
             
   			if self._dbusservice['/StartStop']==0: # Not Loading
   			   current = 5
             
-  			msgCurrent=""
-  			newCurrent = self._updatePVsurplusCharging(powerGrid, powerWallbox, powerBattery, powerBatteryExt, current, maxCurrent, msgCurrent)
-  			self._statusMessage = self._statusMessage + " newCurrent="+str(newCurrent)+" current="+str(current)+" msg="+msgCurrent;   
+  			if self._balancer is not None:
+  			   # the budget of the site balancer stands in for the grid, it already accounts for the batteries
+  			   powerGrid = powerWallbox - self._balancer.allocation(self._chargerName)[0]
+  			   powerBattery = 0
+  			   powerBatteryExt = 0
+  			slot = self._scheduler.lookup() if self._scheduler is not None else None
+  			if slot is not None and slot.evCurrent:
+  			   # cheap grid slot of the plan
+  			   newCurrent = min(slot.evCurrent, maxCurrent)
+  			else:
+  			   newCurrent = self._updatePVsurplusCharging(powerGrid, powerWallbox, powerBattery, powerBatteryExt, current, maxCurrent)
+  			self._lastNewCurrent = newCurrent
+  			self._statusMessage = ("[Status = %s] Mode=1 newCurrent=%s current=%s", status, newCurrent, current)
   			
   			if newCurrent!=current:
   				#print("Set New Current")
   				if self._dbusservice['/ExternalStartStop']==0: # Externes Laden: Deaktiviert -> Set newCurrent 
   					if newCurrent>0:
-  					   logging.info("Activate Loading");
+  					   logWallbox.info("WALLBOX::Activate Loading");
   					elif newCurrent==0:
-  					   logging.info("Deactivate Loading [current=%s newCurrent=%s]" % (current,newCurrent))
+  					   logWallbox.info("WALLBOX::Deactivate Loading [current=%s newCurrent=%s]", current,newCurrent)
   					self._pvSetLoad(newCurrent, maxCurrent, True)
   				elif self._dbusservice['/ExternalSetCurrent']==0:	 # Externes LAden: Aktiviert -> Set cureent ohne Ausschalten
   					#print("ABC")
   					if newCurrent>0:
-  						print("ExternalAktiv set current to ",newCurrent)
+  						logWallbox.info("WALLBOX::External active, set current to %s A", newCurrent)
   						self._pvSetLoad(newCurrent, maxCurrent)
   				#else:
   					#print("ABEE ",self._dbusservice['/ExternalStartStop']," and ",self._dbusservice['/ExternalSetCurrent'])
   		elif mode==2:
-  			self._statusMessage = "[Status = "+str(status)+"] Mode=2";
-  			logging.debug("WALLBOX::Plan Mode")
+  			self._statusMessage = ("[Status = %s] Mode=2", status)
+  			logWallbox.debug("WALLBOX::Plan Mode")
 		
   	else:
-  		self._statusMessage = "[Status=0] No Car";
+  		self._statusMessage = ("[Status=0] No Car",)
   		#logging.info("Wallbox::CALL(_pvSetLoad: Stop Loading) -> no Car")
-  		self._pvUnderloadCount = 0
-  		self._pvOverloadCount = 0
+  		self._powerUnderload.clear()
+  		self._powerOverload.clear()
   		self._pvSetLoad(0, maxCurrent)
 	
   	if status!=self._lastStatus:
@@ -655,222 +2848,342 @@ class DbusGoeChargerService:
         
   	if self._restartCounter > self._restartCounterLimit:
   	   self._enableRestart = True
-  	logging.debug("WALLBOX::Update ... end")
+  	logWallbox.debug("WALLBOX::Update ... end")
 			
   def _update(self): 
     self._frame = self._frame + 1;
-    #print("[",self._frame,"] Start")
+    started = time.perf_counter()
+    
+    try:
+       self._updateWithData(self._chargerData, self._chargerIdle)
+       self._publishHealth()
+       # every update, also while the PV control of an idle charger is skipped
+       if self._balancer is not None:
+          allocationPower, allocationCurrent = self._balancer.allocation(self._chargerName)
+          self._publisher['/Allocation/Power'] = allocationPower
+          self._publisher['/Allocation/Current'] = allocationCurrent
+    finally:
+       # all paths of this update in one signal
+       self._commit()
+       self._stages.since('update', started)
+  
+  def _controlPV(self):
+    data = self._chargerData
+    if self._site is None or data is None or self._chargerIdle:
+       return
+    
+    started = time.perf_counter()
+    try:
+       powerWallbox = int(data['nrg'][11] * 0.01 * 1000)
+       mode = self._goeMode2EvCharger(int(data['ast']))
+       status = self._goeCar2EvCharger(int(data['car']))
+       self._updatePV(status, mode, self._site.gridPower, powerWallbox, self._site.powerBattery, self._site.powerBatteryExt,
+                      int(data['amp']), int(data['ama']))
+    finally:
+       self._commit()
+       self._stages.since('pv', started)
+  
+  def _controlBattery(self):
+    if self._site is None:
+       return
+    
+    started = time.perf_counter()
+    try:
+       self._updateBattery(**self._site._asdict())
+    finally:
+       self._commit()
+       self._stages.since('battery', started)
+  
+  def _controlNightMode(self):
+    if self._site is None:
+       return
+    
+    started = time.perf_counter()
+    site = self._site
+    try:
+       self._updateNightMode(site.gridGridSetPoint, site.powerBatteryMaxDischarge, site.powerBatteryMaxChargeExt,
+                             site.socBattery, site.socBatteryExt, site.socBatteryLimit)
+    finally:
+       self._commit()
+       self._stages.since('nightmode', started)
+  
+  def _publishHealth(self):
+    self._publisher['/Health/Charger'] = self._chargerHealth.state
+    for name, service in self.HEALTH_SERVICES:
+       self._publisher['/Health/%s' % (name)] = self._dbusValues.health(service).state
+  
+  def _commit(self):
+    started = time.perf_counter()
+    self._publisher.commit()
+    self._stages.since('publish', started)
+  
+  def _poll(self):
+    if self._poller is not None:
+       # result is handed to _processChargerData from the GLib loop once it arrives
+       self._poller.poll()
+       return
+    
     #print("[",self._frame,"] Get Wallbox Data")
+    started = time.time()
     try:
-       debug = True
-       debugBattery = False
        #get data from go-eCharger
        data = self._getGoeChargerData()
     except Exception as e:
+       data = None
        logging.critical('Error at _update: Reconnect GoeCharger') 
+    self._pollLatency = time.time() - started
+    
+    self._processChargerData(data)
+  
+  def _onPushData(self, data):
+    if not all(key in data for key in self._source.REQUIRED_KEYS):
+       logging.debug("MQTT::Status incomplete, wait for more messages")
+       return
+    
+    self._processChargerData(self._source.normalize(data))
+  
+  def _isIdle(self, data):
+    # the same status object again means the same response bytes, nothing to parse or compare
+    if data is self._lastData:
+       same = True
+    else:
+       fingerprint = tuple(data.get(key) for key in self.FINGERPRINT_KEYS) + tuple(data['nrg'][4:12])
+       same = fingerprint == self._lastFingerprint
+       self._lastFingerprint = fingerprint
+       self._lastData = data
+    
+    # without a car there is nothing to control, refresh the paths at least every IDLE_REFRESH seconds
+    return same and str(data['car']) == '1' and not self._commands.busy('amp') and not self._commands.busy('alw') \
+           and time.time() - self._lastUpdate < self.IDLE_REFRESH
+  
+  def _processChargerData(self, data):
+    idle = False
+    self._pollCount = self._pollCount + 1
+    if data is None:
+       self._pollErrors = self._pollErrors + 1
+    if data is not None:
+       self._commands.confirm(data)
+       idle = self._isIdle(data)
+       if idle:
+          self._skippedTicks = self._skippedTicks + 1
+       self._polls.setState(int(data['car']))
+    else:
+       self._polls.setState(None)
+    self._chargerData = data
+    self._chargerIdle = idle
     
-    #print("[",self._frame,"] Get Grid")
     try:
-       gridPower = self._powerGrid.GetValue()
-       gridGridSetPoint = self._gridGridSetPoint.GetValue()
-       powerBattery = self._powerBattery.GetValue()
-       powerBatteryMaxCharge = self._powerBatteryMaxCharge.GetValue()
-       powerBatteryMaxDischarge = self._powerBatteryMaxDischarge.GetValue()
-       socBattery = self._socBattery.GetValue()
-       socBatteryLimit = self._socLimit.GetValue()
+       self._publishChargerData(data, idle)
     except Exception as e:
-       logging.critical('Error at _update: Reconnect GridMeter')
-       try:
-          bus = dbus.SystemBus()
-          self._powerGrid = bus.get_object('com.victronenergy.grid.mymeter', '/Ac/Power') 
-          gridPower = 0;
-       except Exception:
-          gridPower = 0;
-       print("[",self._frame,"] End [Reconnect PowerMeter]")
-       return True;
-    
-    #print("[",self._frame,"] Get BatteryExt")    
+       logging.critical('Error at %s', '_publishChargerData', exc_info=e)
+    finally:
+       # all measurement paths of this status in one signal
+       self._commit()
+  
+  def _publishChargerData(self, data, idle=False):
+    if self._poller is not None:
+       self._pollLatency = self._poller.latency
+    if self._pollLatency is not None and not idle:
+       self._publisher['/Debug/PollLatency'] = int(self._pollLatency * 1000)
+    
+    if data is None:
+       logging.debug("Wallbox is not available")
+       return
+    if idle:
+       return
+    
+    #send data to DBus
+    self._phaseModel.update(data['nrg'], self._SetL1, self._SwitchL2L3)
+    self._publisher['/Ac/L1/Power'] = int(self._phaseModel.power[0])
+    self._publisher['/Ac/L2/Power'] = int(self._phaseModel.power[1])
+    self._publisher['/Ac/L3/Power'] = int(self._phaseModel.power[2])
+    
+    numberOfPhase = self._phaseModel.phases
+    if self._phaseMode is not None and numberOfPhase!=self._phaseMode:
+      # the charger pauses to switch and the model still shows the phases of before, keep the forced mode
+      # until current flows on other phases for longer than a switch takes
+      flowing = any(phaseCurrent > 1.0 for phaseCurrent in self._phaseModel.current)
+      if not flowing or time.time() - self._phaseSwitched < self.PHASE_SWITCH_TIMEOUT:
+        numberOfPhase = self._phaseMode
+      else:
+        logWallbox.warning("WALLBOX::Charging on %s phase(s) although %s were forced", numberOfPhase, self._phaseMode)
+        self._phaseMode = None
+    if numberOfPhase!=self._lastNumberOfPhases:
+      logging.info("Detect number of phases of %s", numberOfPhase)
+      self._lastNumberOfPhases = numberOfPhase;
+    
+    self._publisher['/Ac/Power'] = int(data['nrg'][11] * 0.01 * 1000)
+    self._publisher['/Ac/Voltage'] = int(data['nrg'][0])
+    self._publisher['/Current'] = max(data['nrg'][4] * 0.1, data['nrg'][5] * 0.1, data['nrg'][6] * 0.1)
+    self._publisher['/Ac/Energy/Forward'] = int(float(data['eto']) / 10.0)
+    self._lastCurrentAvg = (data['nrg'][4] * 0.1 + data['nrg'][5] * 0.1 + data['nrg'][6] * 0.1)/3
+    
+    current = int(data['amp'])
+    if current!=self._dbusservice['/SetCurrent'] and not self._commands.busy('amp'):
+      self._dbusservice['/SetCurrent'] = current                
+      if self._lastUpdate>0:
+          logWallbox.info("WALLBOX::External changed SetCurrent to %s [goe-App/Wallbox]", current)   
+          self._dbusservice['/ExternalSetCurrent'] = current 
+          self._polls.boost()
+          
+    if not self._commands.busy('ama'):
+      self._publisher['/MaxCurrent'] = int(data['ama'])
+    
+    startStop = int(data['alw'])
+    if startStop!=self._dbusservice['/StartStop'] and not self._commands.busy('alw'):
+      self._dbusservice['/StartStop'] = startStop
+      if self._lastUpdate>0:       
+          logWallbox.info("WALLBOX::External changed StartStop to %s [goe-App/Wallbox]", startStop)            
+          self._dbusservice['/ExternalStartStop'] = startStop
+          if startStop==0:
+              self._dbusservice['/ExternalSetCurrent'] = 0
+          self._polls.boost()
+    
+    # update chargingTime, increment charge time only on active charging (2), reset when no car connected (1)
+    timeDelta = time.time() - self._lastUpdate
+    if int(data['car']) == 2 and self._lastUpdate > 0:  # vehicle loads
+      self._chargingTime += timeDelta
+    elif int(data['car']) == 1:  # charging station ready, no vehicle
+      self._chargingTime = 0
+    self._publisher['/ChargingTime'] = int(self._chargingTime)
+    #print("_dbusservice['/Mode']",self._publisher['/Mode'] )
+    if not self._commands.busy('ast'):
+      self._publisher['/Mode'] = self._goeMode2EvCharger(int(data['ast']))  # Manual, no control
+    
+    if self._charger.hardwareVersion == 3:
+      self._publisher['/MCU/Temperature'] = int(data['tma'][0])
+    else:
+      self._publisher['/MCU/Temperature'] = int(data['tmp'])
+    
+    self._publisher['/Status'] = self._goeCar2EvCharger(int(data['car']))
+    
+    #logging
+    logWallbox.debug("WALLBOX::Consumption (/Ac/Power): %s", self._publisher['/Ac/Power'])
+    logWallbox.debug("WALLBOX::Forward (/Ac/Energy/Forward): %s", self._publisher['/Ac/Energy/Forward'])
+    logging.debug("---")
+    
+    # increment UpdateIndex - to show that new data is available
+    index = self._publisher['/UpdateIndex'] + 1  # increment index
+    if index > 255:   # maximum value of the index
+      index = 0       # overflow from 255 to 0
+    self._publisher['/UpdateIndex'] = index
+
+    #update lastupdate vars
+    self._lastUpdate = time.time()  
+  
+  def _updateWithData(self, data, idle=False):
+    started = time.perf_counter()
     try:
-       powerBatteryExt = self._powerBatteryExt.GetValue()
-       powerBatteryMaxChargeExt  = self._powerBatteryMaxChargeExt.GetValue()
-       powerBatteryMaxDischargeExt = self._powerBatteryMaxDischargeExt.GetValue()
-       socBatteryExt = self._socBatteryExt.GetValue()
+       gridPower = self._dbusValues.get(SERVICE_GRID, '/Ac/Power')
+       gridGridSetPoint = self._dbusValues.get(SERVICE_SETTINGS, '/Settings/CGwacs/AcPowerSetPoint')
+       powerBattery = self._dbusValues.get(SERVICE_VEBUS, '/Dc/0/Power')
+       powerBatteryMaxCharge = self._dbusValues.get(SERVICE_SETTINGS, '/Settings/CGwacs/MaxChargePower')
+       powerBatteryMaxDischarge = self._dbusValues.get(SERVICE_SETTINGS, '/Settings/CGwacs/MaxDischargePower')
+       socBattery = self._dbusValues.get(SERVICE_VEBUS, '/Soc')
+       socBatteryLimit = self._dbusValues.get(SERVICE_SYSTEM, '/Control/ActiveSocLimit')
     except Exception as e:
-       logging.critical('Error at _update: Reconnect VartaStorage')
-       try:
-          bus = dbus.SystemBus()
-          self._powerBatteryExt = bus.get_object('com.victronenergy.acsystem.VartaElement', '/Ac/In/1/P')
-          self._powerBatteryMaxChargeExt = bus.get_object('com.victronenergy.acsystem.VartaElement', '/Ac/In/1/CurrentLimit')
-          self._powerBatteryMaxDischargeExt = bus.get_object('com.victronenergy.acsystem.VartaElement', '/Ac/Out/CurrentLimit')
-          self._socBatteryExt = bus.get_object('com.victronenergy.acsystem.VartaElement', '/Soc')
-          
-          self._powerBatteryMaxDischargeExt_reset = self._powerBatteryMaxDischargeExt.GetValue()
+       # the cache picks the values up again as soon as the service is back, its breaker logs the retries
+       if self._siteAvailable:
+          logging.critical('Error at _update: Waiting for GridMeter (%s)', e)
+          self._siteAvailable = False
+       self._site = None
+       return
+    if not self._siteAvailable:
+       logging.info("GridMeter available again")
+       self._siteAvailable = True
+    
+    try:
+       powerBatteryExt = self._dbusValues.get(SERVICE_VARTA, '/Ac/In/1/P')
+       powerBatteryMaxChargeExt  = self._dbusValues.get(SERVICE_VARTA, '/Ac/In/1/CurrentLimit')
+       powerBatteryMaxDischargeExt = self._dbusValues.get(SERVICE_VARTA, '/Ac/Out/CurrentLimit')
+       socBatteryExt = self._dbusValues.get(SERVICE_VARTA, '/Soc')
+       
+       if not self._vartaConnected:
+          logging.info("VartaStorage connected again")
+          self._vartaConnected = True
+          self._powerBatteryMaxDischargeExt_reset = powerBatteryMaxDischargeExt
           self._powerBatteryMaxDischargeExt_last = self._powerBatteryMaxDischargeExt_reset;
-          
-          powerBatteryExt = 0;
-          powerBatteryMaxChargeExt = 4000;
-          powerBatteryMaxDischargeExt = -4000;
-          socBatteryExt = 0;
-       except Exception:
-          powerBatteryExt = 0;
-          powerBatteryMaxChargeExt = 4000;
-          powerBatteryMaxDischargeExt = -4000;#
-          socBatteryExt = 0;
+          if self._powerBatteryMaxChargeExt_reset is None:
+             self._powerBatteryMaxChargeExt_reset = powerBatteryMaxChargeExt
+             self._powerBatteryMaxChargeExt_last = self._powerBatteryMaxChargeExt_reset;
+    except Exception as e:
+       if self._vartaConnected:
+          logging.critical('Error at _update: Waiting for VartaStorage (%s)' % (e))
+          self._vartaConnected = False
+       powerBatteryExt = 0;
+       powerBatteryMaxChargeExt = 4000;
+       powerBatteryMaxDischargeExt = -4000;
+       socBatteryExt = 0;
+    self._stages.since('dbus', started)
         
     try:   
-       #print("[",self._frame,"] Get External Correction") 
-       #Check if maxCharge is changed external
-       if powerBatteryMaxCharge!=self._powerBatteryMaxCharge_reset and powerBatteryMaxCharge!=self._powerBatteryMaxCharge_last:
-          self._powerBatteryMaxCharge_reset = powerBatteryMaxCharge
-          logging.info("Set max. charge value by reset to %s W" % (powerBatteryMaxCharge))
+       # the batteries and the grid set-point belong to the site, only the primary charger controls them
+       if self._primary:
+          #print("[",self._frame,"] Get External Correction") 
+          #Check if maxCharge is changed external
+          if powerBatteryMaxCharge!=self._powerBatteryMaxCharge_reset and powerBatteryMaxCharge!=self._powerBatteryMaxCharge_last:
+             self._powerBatteryMaxCharge_reset = powerBatteryMaxCharge
+             logging.info("Set max. charge value by reset to %s W", powerBatteryMaxCharge)
        
-       #Check if maxDischarge is changed external
-       if powerBatteryMaxDischarge!=self._powerBatteryMaxDischarge_reset and powerBatteryMaxDischarge!=self._powerBatteryMaxDischarge_last:
-          self._powerBatteryMaxDischarge_reset = powerBatteryMaxDischarge
-          logging.info("Set max. charge value by reset to %s W" % (powerBatteryMaxDischarge))
+          #Check if maxDischarge is changed external
+          if powerBatteryMaxDischarge!=self._powerBatteryMaxDischarge_reset and powerBatteryMaxDischarge!=self._powerBatteryMaxDischarge_last:
+             self._powerBatteryMaxDischarge_reset = powerBatteryMaxDischarge
+             logging.info("Set max. charge value by reset to %s W", powerBatteryMaxDischarge)
        
-       if gridGridSetPoint!=self._gridGridSetPoint_last and self._gridGridSetPoint_reset!=self._gridGridSetPoint_last:
-          self._gridGridSetPoint_reset = gridGridSetPoint
-          logging.info("Set GridSetPoint value by reset to %s W" % (gridGridSetPoint))
+          if gridGridSetPoint!=self._gridGridSetPoint_reset and gridGridSetPoint!=self._gridGridSetPoint_last:
+             self._gridGridSetPoint_reset = gridGridSetPoint
+             logging.info("Set GridSetPoint value by reset to %s W", gridGridSetPoint)
        
-       #Action
-       #print("[",self._frame,"] Update Battery") 
-       self._updateBattery(gridPower, gridGridSetPoint, powerBattery, powerBatteryExt, powerBatteryMaxCharge, powerBatteryMaxDischarge, powerBatteryMaxChargeExt, powerBatteryMaxDischargeExt, socBattery, socBatteryExt, socBatteryLimit)
-		  
+          # the battery controller works on the windows of one battery period
+          self._powerBattery.add(powerBattery)
+          self._powerBatteryExt.add(powerBatteryExt)
+          self._gridPower.add(gridPower)
        
-       if data is not None:
-          #send data to DBus
-          powerL1 = int(data['nrg'][7] * 0.1 * 1000)
-          powerL2 = int(data['nrg'][8] * 0.1 * 1000)
-          powerL3 = int(data['nrg'][9] * 0.1 * 1000)
-          if self._SetL1==2:
-             self._dbusservice['/Ac/L1/Power'] = powerL2
-             if self._SwitchL2L3==True:
-                self._dbusservice['/Ac/L2/Power'] = powerL1
-                self._dbusservice['/Ac/L3/Power'] = powerL3
-             else:
-                self._dbusservice['/Ac/L2/Power'] = powerL3
-                self._dbusservice['/Ac/L3/Power'] = powerL1
-          elif self._SetL1==3:
-             self._dbusservice['/Ac/L1/Power'] = powerL3
-             if self._SwitchL2L3==True:
-                self._dbusservice['/Ac/L2/Power'] = powerL1
-                self._dbusservice['/Ac/L3/Power'] = powerL2
-             else:
-                self._dbusservice['/Ac/L2/Power'] = powerL2
-                self._dbusservice['/Ac/L3/Power'] = powerL1
-          else:
-             self._dbusservice['/Ac/L1/Power'] = powerL1
-             if self._SwitchL2L3==True:
-                self._dbusservice['/Ac/L2/Power'] = powerL3
-                self._dbusservice['/Ac/L3/Power'] = powerL2
-             else:
-                self._dbusservice['/Ac/L2/Power'] = powerL2
-                self._dbusservice['/Ac/L3/Power'] = powerL3
-          
-          numberOfPhase = self._getNumberOfPhases(powerL1,powerL2,powerL3)
-          if numberOfPhase!=0 and numberOfPhase!=self._lastNumberOfPhases:
-            logging.info("Detect number of phases of %s" % (numberOfPhase))
-            self._lastNumberOfPhases = numberOfPhase;
-          
-          powerWallbox = int(data['nrg'][11] * 0.01 * 1000)
-          self._dbusservice['/Ac/Power'] = powerWallbox
-          self._dbusservice['/Ac/Voltage'] = int(data['nrg'][0])
-          self._dbusservice['/Current'] = max(data['nrg'][4] * 0.1, data['nrg'][5] * 0.1, data['nrg'][6] * 0.1)
-          self._dbusservice['/Ac/Energy/Forward'] = int(float(data['eto']) / 10.0)
-          self._lastCurrentAvg = (data['nrg'][4] * 0.1 + data['nrg'][5] * 0.1 + data['nrg'][6] * 0.1)/3
-          
-          current = int(data['amp'])
-          if current!=self._dbusservice['/SetCurrent']:
-            self._dbusservice['/SetCurrent'] = current                
-            if self._lastUpdate>0:
-                logging.info("External changed SetCurrent to %s [goe-App/Wallbox]" % (current))   
-                self._dbusservice['/ExternalSetCurrent'] = current 
-                
-          maxCurrent = int(data['ama']) 
-          self._dbusservice['/MaxCurrent'] = maxCurrent
-          
-          startStop = int(data['alw'])
-          if startStop!=self._dbusservice['/StartStop']:
-            self._dbusservice['/StartStop'] = startStop
-            if self._lastUpdate>0:       
-                logging.info("External changed StartStop to %s [goe-App/Wallbox]" % (startStop))            
-                self._dbusservice['/ExternalStartStop'] = startStop
-                if startStop==0:
-                    self._dbusservice['/ExternalSetCurrent'] = 0
-          
-          # update chargingTime, increment charge time only on active charging (2), reset when no car connected (1)
-          timeDelta = time.time() - self._lastUpdate
-          if int(data['car']) == 2 and self._lastUpdate > 0:  # vehicle loads
-            self._chargingTime += timeDelta
-          elif int(data['car']) == 1:  # charging station ready, no vehicle
-            self._chargingTime = 0
-          self._dbusservice['/ChargingTime'] = int(self._chargingTime)
-          #print("_dbusservice['/Mode']",self._dbusservice['/Mode'] )
-          mode = self._goeMode2EvCharger(int(data['ast']))  # Manual, no control
-          self._dbusservice['/Mode'] = mode
-          
-          config = self._getConfig()
-          hardwareVersion = int(config['DEFAULT']['HardwareVersion'])
-          if hardwareVersion == 3:
-            self._dbusservice['/MCU/Temperature'] = int(data['tma'][0])
-          else:
-            self._dbusservice['/MCU/Temperature'] = int(data['tmp'])
-
-          
-          # value 'car' 1: charging station ready, no vehicle 2: vehicle loads 3: Waiting for vehicle 4: Charge finished, vehicle still connected
-          status = 0
-          if int(data['car']) == 1:
-            status = 0
-          elif int(data['car']) == 2:
-            status = 2
-          elif int(data['car']) == 3:
-            status = 6
-          elif int(data['car']) == 4:
-            status = 3
-          self._dbusservice['/Status'] = status
-
-          
-          #action
-          #print("updatePV start")
-          self._updatePV(status, mode,  gridPower, powerWallbox, powerBattery, powerBatteryExt, current, maxCurrent)
-          #print("updatePV end")
-                  
-          
-                
-
-          #logging
-          logging.debug("Wallbox Consumption (/Ac/Power): %s" % (self._dbusservice['/Ac/Power']))
-          logging.debug("Wallbox Forward (/Ac/Energy/Forward): %s" % (self._dbusservice['/Ac/Energy/Forward']))
-          logging.debug("---")
-          
-          # increment UpdateIndex - to show that new data is available
-          index = self._dbusservice['/UpdateIndex'] + 1  # increment index
-          if index > 255:   # maximum value of the index
-            index = 0       # overflow from 255 to 0
-          self._dbusservice['/UpdateIndex'] = index
-
-          #update lastupdate vars
-          self._lastUpdate = time.time()  
-       else:
-          logging.debug("Wallbox is not available")
+       self._site = SiteValues(gridPower, gridGridSetPoint, powerBattery, powerBatteryExt, powerBatteryMaxCharge, powerBatteryMaxDischarge,
+                               powerBatteryMaxChargeExt, powerBatteryMaxDischargeExt, socBattery, socBatteryExt, socBatteryLimit)
+       
+       # site budget of this charger, computed for all chargers at once
+       if self._balancer is not None and data is not None and not idle:
+          mode = self._goeMode2EvCharger(int(data['ast']))
+          status = self._goeCar2EvCharger(int(data['car']))
+          self._balancer.report(self._chargerName, status!=0 and mode==1, int(data['nrg'][11] * 0.01 * 1000),
+                                self._phaseModel.wattsPerAmp(self._lastNumberOfPhases), int(data['alw'])==1, int(data['ama']))
+       
+       if self._recorder is not None:
+          self._record(data, gridPower, powerBattery, socBattery, powerBatteryExt, socBatteryExt)
 
     except Exception as e:
        logging.critical('Error at %s', '_update', exc_info=e)
-       
-    # return true, otherwise add_timeout will be removed from GObject - see docs http://library.isr.ist.utl.pt/docs/pygtk2reference/gobject-functions.html#function-gobject--timeout-add
-    #print("[",self._frame,"] End")
-    return True
+  
+  def _record(self, data, gridPower, powerBattery, socBattery, powerBatteryExt, socBatteryExt):
+    nan = float('nan')
+    if data is not None:
+       powerWallbox = data['nrg'][11] * 0.01 * 1000
+       amp, alw, car = int(data['amp']), int(data['alw']), int(data['car'])
+    else:
+       powerWallbox = nan
+       amp = alw = car = 255
+    newCurrent = 255 if self._lastNewCurrent is None else int(self._lastNewCurrent)
+    self._lastNewCurrent = None
+    
+    def _value(value):
+       return nan if value is None else value
+    
+    self._recorder.append(time.time(), gridPower, powerBattery, socBattery, powerBatteryExt, socBatteryExt, powerWallbox,
+                          amp, alw, car, newCurrent, int(self._dbusservice['/SetCurrent']), int(self._dbusservice['/StartStop']),
+                          _value(self._powerBatteryMaxCharge_last), _value(self._powerBatteryMaxDischarge_last),
+                          _value(self._powerBatteryMaxChargeExt_last), _value(self._powerBatteryMaxDischargeExt_last),
+                          _value(self._gridGridSetPoint_last), int(self._nightMode))
  
   def _handlechangedvalue(self, path, value):
     #logging.info("someone else updated %s to %s" % (path, value))
     #print("_handlechangedvalue ",path, "=",value)
     if path == '/SetCurrent':
-      logging.info("External changed SetCurrent to %s [VRM]" % (value))
+      logging.info("External changed SetCurrent to %s [VRM]", value)
       self._dbusservice['/ExternalSetCurrent'] = value 
       return self._setGoeChargerValue('amp', value)
     elif path == '/StartStop':
-      logging.info("External changed StartStop to %s [VRM]" % (value))
+      logging.info("External changed StartStop to %s [VRM]", value)
       self._dbusservice['/ExternalStartStop'] = value
       if value==0:
       	self._dbusservice['/ExternalSetCurrent'] = 0
@@ -878,17 +3191,55 @@ class DbusGoeChargerService:
     elif path == '/MaxCurrent':
       return self._setGoeChargerValue('ama', value)
     elif path == '/Mode':
-      logging.info("External changed Mode to %s [VRM]" % (value))
+      logging.info("External changed Mode to %s [VRM]", value)
       return self._setGoeChargerValue('ast', self._evCharger2GoeMode(value))    
     else:
-      logging.info("mapping for evcharger path %s does not exist" % (path))
+      logging.info("mapping for evcharger path %s does not exist", path)
       return False
 
+def setLogLevels(default):
+  # with a debug history every logger creates DEBUG records and only the output is filtered,
+  # otherwise the loggers drop what is below their level before any record is built
+  levels = dict(default.subsystemLogLevels)
+  logOutputLevels.configure(default.logLevel, levels)
+  history = logDebugHistory is not None
+  logging.getLogger().setLevel(logging.DEBUG if history else default.logLevel)
+  for logger in SUBSYSTEM_LOGGERS:
+    logger.setLevel(logging.NOTSET if history else levels.get(logger.name, logging.NOTSET))
+
 def end(service):
-  service.reset()
-  print('Goodbye');
+  # buffered records and charger writes first, the reset needs the settings service
+  if service._recorder is not None:
+    service._recorder.flush()
+  service._commands.flush()
+  if service._primary:
+    try:
+      service.reset()
+    except Exception as e:
+      logBattery.error("BATT::Reset of the battery limits failed: %s", e)
+  logging.info('Goodbye')
+
+def dbusConnection(private=False):
+  # same bus velib's VeDbusService picks, the session bus allows running against tools/goecharger-simulator.py
+  if 'DBUS_SESSION_BUS_ADDRESS' in os.environ:
+    return dbus.SessionBus(private=private)
+  return dbus.SystemBus(private=private)
+
+def dumpRecording(paths):
+  # CSV of one or more recordings, oldest file first
+  fields = [name for name, fmt in Recorder.FIELDS]
+  print(','.join(fields))
+  for path in paths:
+    for record in Recorder.read(path):
+      row = dict(record._asdict())
+      row['time'] = datetime.fromtimestamp(row['time']).strftime('%Y-%m-%d %H:%M:%S')
+      print(','.join(str(row.get(name, '')) for name in fields))
 
 def main():
+  if len(sys.argv) > 2 and sys.argv[1] == '--dump-recording':
+    dumpRecording(sys.argv[2:])
+    return
+  
   #configure logging
   '''
   logging.basicConfig(      format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
@@ -901,14 +3252,32 @@ def main():
                             ])
   '''
 	#filename=("%s/goeCharger_Vorne.log" % (os.path.dirname(os.path.realpath(__file__)))), 
-  logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S', 
-					    #filemode='w',                        
-                        level=logging.INFO,
-                            handlers=[
-                                logging.FileHandler("%s/goeCharger_Vorne.log" % (os.path.dirname(os.path.realpath(__file__)))),
-                                logging.StreamHandler()
-                            ])
+  config = ConfigFile("%s/config.ini" % (os.path.dirname(os.path.realpath(__file__))))
+  global logDebugHistory
+  default = config.settings.default
+  # bounded on the flash: LogBackups files of at most LogMaxSize bytes
+  handlers = [RotatingFileHandler(default.logFile, maxBytes=default.logMaxSize, backupCount=default.logBackups), logging.StreamHandler()]
+  for handler in handlers:
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s', '%Y-%m-%d %H:%M:%S'))
+    handler.addFilter(logOutputLevels)
+  if default.debugHistory > 0:
+    logDebugHistory = DebugHistory(default.logFile + '.debug', default.debugHistory)
+    handlers.append(logDebugHistory)
+    if hasattr(gobject, 'unix_signal_add'):
+      # SIGUSR2 writes the debug history next to the log-file
+      gobject.unix_signal_add(gobject.PRIORITY_DEFAULT, signal.SIGUSR2, logDebugHistory.dump)
+  # the loop only puts records into a queue, a thread of the listener writes them to the file
+  logQueue = queue.Queue()
+  queueHandler = QueueHandler(logQueue)
+  # the message only, the handlers of the listener add time and level
+  queueHandler.setFormatter(logging.Formatter('%(message)s'))
+  queueHandler.addFilter(RepeatFilter())
+  listener = QueueListener(logQueue, *handlers)
+  listener.start()
+  # registered first, so it runs last and writes the messages of the other exit handlers
+  atexit.register(listener.stop)
+  logging.basicConfig(level=logging.INFO, handlers=[queueHandler])
+  setLogLevels(default)
   try:
       logging.info("Start")
   
@@ -925,30 +3294,93 @@ def main():
       _s = lambda p, v: (str(v) + 's')
       _n = lambda p, v: (str(v))
      
-      #start our main-service
-      pvac_output = DbusGoeChargerService(
-        servicename='com.victronenergy.evcharger',
-        paths={
-          '/Ac/Power': {'initial': 0, 'textformat': _w},
-          '/Ac/L1/Power': {'initial': 0, 'textformat': _w},
-          '/Ac/L2/Power': {'initial': 0, 'textformat': _w},
-          '/Ac/L3/Power': {'initial': 0, 'textformat': _w},
-          '/Ac/Energy/Forward': {'initial': 0, 'textformat': _kwh},
-          '/ChargingTime': {'initial': 0, 'textformat': _s},
-          
-          '/Ac/Voltage': {'initial': 0, 'textformat': _v},
-          '/Current': {'initial': 0, 'textformat': _a},
-          '/SetCurrent': {'initial': 0, 'textformat': _a},
-          '/ExternalSetCurrent': {'initial': 0, 'textformat': _a},
-          '/MaxCurrent': {'initial': 0, 'textformat': _a},
-          '/MCU/Temperature': {'initial': 0, 'textformat': _degC},
-          '/StartStop': {'initial': 0, 'textformat': _n},
-          '/ExternalStartStop': {'initial': 0, 'textformat': _n},			
-          '/Mode':  {'initial': 0, 'textformat': _n},
-          '/Status':  {'initial': 0, 'textformat': _n},
-        }
-        )
-      atexit.register(end, pvac_output)
+      paths={
+        # deadband/relDeadband/maxInterval: publish only changes past the deadband, at least every maxInterval seconds
+        '/Ac/Power': {'initial': 0, 'textformat': _w, 'deadband': 10, 'maxInterval': 60},
+        '/Ac/L1/Power': {'initial': 0, 'textformat': _w, 'deadband': 20, 'relDeadband': 0.02, 'maxInterval': 60},
+        '/Ac/L2/Power': {'initial': 0, 'textformat': _w, 'deadband': 20, 'relDeadband': 0.02, 'maxInterval': 60},
+        '/Ac/L3/Power': {'initial': 0, 'textformat': _w, 'deadband': 20, 'relDeadband': 0.02, 'maxInterval': 60},
+        '/Ac/Energy/Forward': {'initial': 0, 'textformat': _kwh},
+        '/ChargingTime': {'initial': 0, 'textformat': _s},
+        
+        '/Ac/Voltage': {'initial': 0, 'textformat': _v, 'deadband': 2, 'maxInterval': 60},
+        '/Current': {'initial': 0, 'textformat': _a, 'deadband': 0.2, 'maxInterval': 60},
+        '/SetCurrent': {'initial': 0, 'textformat': _a},
+        '/ExternalSetCurrent': {'initial': 0, 'textformat': _a},
+        '/MaxCurrent': {'initial': 0, 'textformat': _a},
+        '/MCU/Temperature': {'initial': 0, 'textformat': _degC, 'deadband': 1, 'maxInterval': 300},
+        '/StartStop': {'initial': 0, 'textformat': _n},
+        '/ExternalStartStop': {'initial': 0, 'textformat': _n},			
+        '/Mode':  {'initial': 0, 'textformat': _n},
+        '/Status':  {'initial': 0, 'textformat': _n},
+      }
+      
+      chargers = config.settings.chargers
+      dbusValues = DbusValueCache(dbusConnection(), signalling=(SERVICE_SETTINGS, SERVICE_SYSTEM),
+                                  backoff=config.settings.default.backoff, backoffMax=config.settings.default.backoffMax)
+      for service, path in ((SERVICE_GRID, '/Ac/Power'),
+                            (SERVICE_SETTINGS, '/Settings/CGwacs/AcPowerSetPoint'),
+                            (SERVICE_SETTINGS, '/Settings/CGwacs/MaxChargePower'),
+                            (SERVICE_SETTINGS, '/Settings/CGwacs/MaxDischargePower'),
+                            (SERVICE_VEBUS, '/Dc/0/Power'),
+                            (SERVICE_VEBUS, '/Soc'),
+                            (SERVICE_SYSTEM, '/Control/ActiveSocLimit'),
+                            (SERVICE_VARTA, '/Ac/In/1/P'),
+                            (SERVICE_VARTA, '/Ac/In/1/CurrentLimit'),
+                            (SERVICE_VARTA, '/Ac/Out/CurrentLimit'),
+                            (SERVICE_VARTA, '/Soc')):
+        dbusValues.add(service, path)
+      
+      # several chargers are polled concurrently on the workers of one executor, each with its own bus connection
+      executor = None
+      if len(chargers) > 1:
+        executor = ThreadPoolExecutor(max_workers=len(chargers) * max(1, config.settings.default.pollsInFlight))
+      
+      # several chargers share the surplus through one balancer instead of each chasing the grid reading
+      balancer = None
+      if len(chargers) > 1:
+        balancer = SiteLoadBalancer(dbusValues, config.settings.balancer.mainFuse, config.settings.default.pollStaleAfter)
+        gobject.timeout_add(config.settings.default.updateInterval, balancer.tick)
+      
+      # forecast driven night mode and grid charging, replanned in the background of the update ticks
+      scheduler = None
+      if config.settings.schedule.forecastFile:
+        scheduler = ChargingScheduler(config.settings.schedule, config.settings.nightMode)
+        gobject.timeout_add(int(config.settings.schedule.replanInterval * 1000), scheduler.replan)
+      
+      # counters and gauges for Prometheus, rendered on the loop and served by a thread
+      exporter = None
+      if config.settings.metrics.port:
+        metrics = config.settings.metrics
+        try:
+          exporter = MetricsExporter(metrics.address, metrics.port, metrics.interval)
+          atexit.register(exporter.stop)
+          logging.info("Metrics on http://%s:%s/metrics", metrics.address, metrics.port)
+        except OSError as e:
+          # optional, the chargers run without it
+          logging.error("Metrics on %s:%s not available: %s", metrics.address, metrics.port, e)
+      
+      #start our main-service, the first charger is the primary one
+      for index, charger in enumerate(chargers):
+        pvac_output = DbusGoeChargerService(
+          servicename='com.victronenergy.evcharger',
+          paths=paths,
+          config=config,
+          chargerName=charger.name,
+          dbusValues=dbusValues,
+          executor=executor,
+          bus=dbusConnection(private=True) if executor is not None else None,
+          primary=(index == 0),
+          balancer=balancer,
+          scheduler=scheduler
+          )
+        atexit.register(end, pvac_output)
+        if exporter is not None:
+          exporter.register(pvac_output.metrics)
+        logging.info("Charger %s (%s) on com.victronenergy.evcharger.http_%02d", charger.name or charger.guiName, charger.host, charger.deviceinstance)
+      if exporter is not None:
+        # scrapes before the first interval get the state of the start
+        exporter.render()
       
       logging.info('Connected to dbus, and switching over to gobject.MainLoop() (= event based)')
       mainloop = gobject.MainLoop()
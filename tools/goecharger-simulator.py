@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+"""Offline test bench for dbus-goecharger.
+
+Answers /status and /mqtt?payload= (and the API v2 /api/status and /api/set) like a go-eCharger and
+registers stub grid meter, vebus, settings, system and VartaElement services on D-Bus. PV production,
+house consumption and car state are replayed from a scenario CSV at a multiple of real time, the
+battery and the grid react to what the charger draws.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import dbus
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+# velib from Venus OS or a checkout given by VELIB_PYTHON
+sys.path.insert(1, os.environ.get('VELIB_PYTHON', '/opt/victronenergy/dbus-systemcalc-py/ext/velib_python'))
+from vedbus import VeDbusService
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def parseTime(value):
+  # "HH:MM[:SS]" or seconds since midnight
+  if ':' in value:
+    parts = [int(part) for part in value.split(':')]
+    while len(parts) < 3:
+      parts.append(0)
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+  return float(value)
+
+
+class Scenario:
+  """Time series with columns time, pv, consumption, car and optional soc/socExt, linear in between."""
+  def __init__(self, path):
+    self._rows = []
+    with open(path) as f:
+      for row in csv.DictReader(f):
+        self._rows.append((parseTime(row['time']), row))
+    if not self._rows:
+      raise ValueError("Scenario %s is empty" % (path))
+    self._rows.sort(key=lambda entry: entry[0])
+  
+  @property
+  def start(self):
+    return self._rows[0][0]
+  
+  @property
+  def end(self):
+    return self._rows[-1][0]
+  
+  def at(self, t):
+    before = self._rows[0]
+    after = self._rows[-1]
+    for entry in self._rows:
+      if entry[0] <= t:
+        before = entry
+      else:
+        after = entry
+        break
+    
+    span = after[0] - before[0]
+    factor = (t - before[0]) / span if span > 0 and t > before[0] else 0.0
+    values = {}
+    for key in ('pv', 'consumption', 'soc', 'socExt'):
+      if before[1].get(key) not in (None, ''):
+        low = float(before[1][key])
+        high = float(after[1][key]) if after[1].get(key) not in (None, '') else low
+        values[key] = low + (high - low) * factor
+    # the car is plugged in or out, never half
+    values['car'] = int(before[1].get('car') or 1)
+    return values
+
+
+class SimulatedSite:
+  """Charger, ESS battery, Varta storage and grid connection driven by the scenario."""
+  def __init__(self, phases=3, voltage=230.0):
+    self._lock = threading.Lock()
+    self._phases = phases
+    self._voltage = voltage
+    
+    with open(os.path.join(BASE_DIR, 'docs', 'go-eCharger-status-sample.json')) as f:
+      self.status = json.load(f)
+    self.status.update({'car': '1', 'amp': '16', 'alw': '0', 'ast': '0', 'ama': '16'})
+    self._energy = float(self.status['eto']) * 100.0    # Wh
+    
+    self.pv = 0.0
+    self.consumption = 0.0
+    self.wallbox = 0.0
+    self.battery = 0.0
+    self.batteryExt = 0.0
+    self.grid = 0.0
+    self.soc = 50.0
+    self.socExt = 50.0
+    
+    self.polls = 0
+    self.writes = []
+    self.gridImport = 0.0
+    self.gridExport = 0.0
+    self.evEnergy = 0.0
+  
+  def getStatus(self):
+    with self._lock:
+      self.polls = self.polls + 1
+      return dict(self.status)
+  
+  def getStatusV2(self):
+    # API v2 types and units: numbers, bool alw, nrg in V, A and W, eto in Wh
+    with self._lock:
+      self.polls = self.polls + 1
+      status = dict(self.status)
+      energy = self._energy
+    nrg = status['nrg']
+    return {'nrg': nrg[0:4] + [value / 10.0 for value in nrg[4:7]] + [value * 100.0 for value in nrg[7:11]] +
+                   [nrg[11] * 10.0] + nrg[12:16],
+            'amp': int(status['amp']), 'ama': int(status['ama']), 'alw': status['alw'] == '1', 'car': int(status['car']),
+            'eto': int(energy), 'tma': [float(status['tmp'])], 'fwv': status['fwv'], 'sse': status['sse'],
+            'psm': int(status.get('psm', 0))}
+  
+  def setValue(self, t, key, value):
+    with self._lock:
+      self.status[key] = str(value)
+      self.writes.append((t, key, str(value)))
+      return dict(self.status)
+  
+  def step(self, t, dt, values, limits):
+    with self._lock:
+      self.pv = values['pv']
+      self.consumption = values['consumption']
+      if 'soc' in values:
+        self.soc = values['soc']
+      if 'socExt' in values:
+        self.socExt = values['socExt']
+      
+      # scenario car 1: no vehicle, anything else: vehicle connected
+      connected = values['car'] != 1
+      charging = connected and self.status['alw'] == '1' and int(self.status['amp']) >= 6
+      amp = int(self.status['amp']) if charging else 0
+      self.status['car'] = '2' if charging else ('3' if connected else '1')
+      self.wallbox = amp * self._voltage * self._phases
+      
+      # ESS keeps the grid at the set-point within the configured limits, the Varta takes the rest
+      available = self.pv - self.consumption - self.wallbox + limits['gridSetPoint']
+      self.battery = max(min(available, limits['maxCharge']), -limits['maxDischarge'])
+      self.batteryExt = max(min(available - self.battery, limits['maxChargeExt']), limits['maxDischargeExt'])
+      self.grid = self.consumption + self.wallbox + self.battery + self.batteryExt - self.pv
+      
+      hours = dt / 3600.0
+      self._energy = self._energy + self.wallbox * hours
+      self.evEnergy = self.evEnergy + self.wallbox * hours
+      if self.grid > 0:
+        self.gridImport = self.gridImport + self.grid * hours
+      else:
+        self.gridExport = self.gridExport - self.grid * hours
+      
+      current = int(amp * 10)
+      power = int(amp * self._voltage / 100.0)
+      self.status['nrg'] = [int(self._voltage)] * 3 + [0] + [current] * self._phases + [0] * (3 - self._phases) + \
+                           [power] * self._phases + [0] * (3 - self._phases) + [0, int(self.wallbox / 10.0)] + [99] * 3 + [0]
+      self.status['eto'] = str(int(self._energy / 100.0))
+      self.status['tme'] = time.strftime('%d%m%y%H%M', time.gmtime(t))
+
+
+class ChargerRequestHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  
+  def log_message(self, format, *args):
+    logging.debug("HTTP::" + format, *args)
+  
+  def _send(self, data, code=200):
+    body = json.dumps(data).encode('utf-8')
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+  
+  def do_GET(self):
+    site = self.server.site
+    url = urlparse(self.path)
+    query = parse_qs(url.query)
+    
+    if url.path == '/status':
+      self._send(site.getStatus())
+    elif url.path == '/mqtt' and 'payload' in query:
+      key, value = query['payload'][0].split('=', 1)
+      self._send(site.setValue(self.server.clock(), key, value))
+    elif url.path == '/api/status':
+      status = site.getStatusV2()
+      keys = query.get('filter', [','.join(status.keys())])[0].split(',')
+      self._send(dict((key, status.get(key)) for key in keys))
+    elif url.path == '/api/set':
+      for key, values in query.items():
+        if key == 'frc':
+          site.setValue(self.server.clock(), 'alw', 1 if values[0] == '2' else 0)
+        else:
+          site.setValue(self.server.clock(), key, values[0])
+      self._send(dict((key, True) for key in query))
+    else:
+      self._send({'error': 'not found'}, 404)
+
+
+class ChargerServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+class StubServices:
+  """The D-Bus services dbus-goecharger reads, with values taken from the simulated site."""
+  def __init__(self, site):
+    self._site = site
+    self._services = {}
+    
+    self._add('com.victronenergy.grid.mymeter', {'/Ac/Power': 0.0})
+    self._add('com.victronenergy.vebus.ttyS4', {'/Dc/0/Power': 0.0, '/Soc': site.soc})
+    self._add('com.victronenergy.system', {'/Control/ActiveSocLimit': 20.0})
+    self._add('com.victronenergy.settings', {'/Settings/CGwacs/AcPowerSetPoint': 50,
+                                             '/Settings/CGwacs/MaxChargePower': 5000,
+                                             '/Settings/CGwacs/MaxDischargePower': 5000})
+    self._add('com.victronenergy.acsystem.VartaElement', {'/Ac/In/1/P': 0.0, '/Ac/In/1/CurrentLimit': 4000,
+                                                          '/Ac/Out/CurrentLimit': -4000, '/Soc': site.socExt})
+  
+  def _add(self, name, paths):
+    # every service needs its own connection
+    if 'DBUS_SESSION_BUS_ADDRESS' in os.environ:
+      bus = dbus.SessionBus(private=True)
+    else:
+      bus = dbus.SystemBus(private=True)
+    service = VeDbusService(name, bus=bus, register=False)
+    for path, value in paths.items():
+      service.add_path(path, value, writeable=True, onchangecallback=lambda path, value: True)
+    service.register()
+    self._services[name] = service
+  
+  def limits(self):
+    settings = self._services['com.victronenergy.settings']
+    varta = self._services['com.victronenergy.acsystem.VartaElement']
+    return {'gridSetPoint': settings['/Settings/CGwacs/AcPowerSetPoint'],
+            'maxCharge': settings['/Settings/CGwacs/MaxChargePower'],
+            'maxDischarge': settings['/Settings/CGwacs/MaxDischargePower'],
+            'maxChargeExt': varta['/Ac/In/1/CurrentLimit'],
+            'maxDischargeExt': varta['/Ac/Out/CurrentLimit']}
+  
+  def publish(self):
+    site = self._site
+    with self._services['com.victronenergy.grid.mymeter'] as service:
+      service['/Ac/Power'] = round(site.grid, 1)
+    with self._services['com.victronenergy.vebus.ttyS4'] as service:
+      service['/Dc/0/Power'] = round(site.battery, 1)
+      service['/Soc'] = round(site.soc, 1)
+    with self._services['com.victronenergy.acsystem.VartaElement'] as service:
+      service['/Ac/In/1/P'] = round(site.batteryExt, 1)
+
+
+class Simulator:
+  def __init__(self, scenario, site, services, speed, start, end, output, step=0.1):
+    self._scenario = scenario
+    self._site = site
+    self._services = services
+    self._speed = speed
+    self._end = end
+    self._stepInterval = step
+    
+    self._wallStart = time.time()
+    self._simStart = start
+    self._lastStep = start
+    self._lastSample = None
+    
+    self._output = None
+    if output:
+      self._output = open(output, 'w')
+      self._writer = csv.writer(self._output)
+      self._writer.writerow(['time', 'pv', 'consumption', 'wallbox', 'battery', 'batteryExt', 'grid', 'car', 'alw', 'amp'])
+  
+  def clock(self):
+    return self._simStart + (time.time() - self._wallStart) * self._speed
+  
+  def step(self):
+    t = min(self.clock(), self._end)
+    self._site.step(t, t - self._lastStep, self._scenario.at(t), self._services.limits())
+    self._services.publish()
+    self._lastStep = t
+    
+    if self._output is not None and (self._lastSample is None or t - self._lastSample >= 60):
+      self._lastSample = t
+      site = self._site
+      self._writer.writerow([time.strftime('%H:%M:%S', time.gmtime(t)), int(site.pv), int(site.consumption), int(site.wallbox),
+                             int(site.battery), int(site.batteryExt), int(site.grid), site.status['car'], site.status['alw'], site.status['amp']])
+    
+    if t >= self._end:
+      self._mainloop.quit()
+      return False
+    return True
+  
+  def run(self):
+    self._mainloop = GLib.MainLoop()
+    GLib.timeout_add(int(self._stepInterval * 1000), self.step)
+    self._mainloop.run()
+    if self._output is not None:
+      self._output.close()
+  
+  def summary(self):
+    site = self._site
+    wall = time.time() - self._wallStart
+    simulated = self._lastStep - self._simStart
+    logging.info("Simulated %.1f h in %.1f s (x%.0f)" % (simulated / 3600.0, wall, simulated / wall if wall else 0))
+    logging.info("Charger polls: %s (%.1f/s) writes: %s" % (site.polls, site.polls / wall if wall else 0, len(site.writes)))
+    logging.info("EV energy: %.2f kWh grid import: %.2f kWh grid export: %.2f kWh" % (site.evEnergy / 1000.0, site.gridImport / 1000.0, site.gridExport / 1000.0))
+    for t, key, value in site.writes:
+      logging.info("  %s %s=%s" % (time.strftime('%H:%M:%S', time.gmtime(t)), key, value))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('scenario', help="CSV file with columns time,pv,consumption,car[,soc,socExt]")
+  parser.add_argument('--port', type=int, default=8080, help="HTTP port of the simulated charger (default 8080)")
+  parser.add_argument('--speed', type=float, default=1.0, help="simulated seconds per real second (default 1)")
+  parser.add_argument('--start', help="start time of day, default begin of the scenario")
+  parser.add_argument('--end', help="end time of day, default end of the scenario")
+  parser.add_argument('--phases', type=int, default=3, choices=(1, 2, 3), help="phases the car charges with (default 3)")
+  parser.add_argument('--output', help="write one CSV sample per simulated minute to this file")
+  parser.add_argument('--debug', action='store_true')
+  args = parser.parse_args()
+  
+  logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+                      level=logging.DEBUG if args.debug else logging.INFO)
+  
+  DBusGMainLoop(set_as_default=True)
+  
+  scenario = Scenario(args.scenario)
+  start = parseTime(args.start) if args.start else scenario.start
+  end = parseTime(args.end) if args.end else scenario.end
+  
+  site = SimulatedSite(phases=args.phases)
+  services = StubServices(site)
+  simulator = Simulator(scenario, site, services, args.speed, start, end, args.output)
+  
+  server = ChargerServer(('', args.port), ChargerRequestHandler)
+  server.site = site
+  server.clock = simulator.clock
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  logging.info("Simulated go-eCharger on port %s, replaying %s at x%s" % (args.port, args.scenario, args.speed))
+  
+  try:
+    simulator.run()
+  except KeyboardInterrupt:
+    pass
+  server.shutdown()
+  simulator.summary()
+
+
+if __name__ == "__main__":
+  main()